@@ -0,0 +1,117 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .mdp import MDP
+from .characters import AdventurerLearning, RandomAdventurer, Qlearning
+from .states import StateIndex, StateSpace
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+class PolicyAnalysis(object):
+    """
+    Exact analysis of a policy, played on the model of its dungeon.
+
+    Following the policy turns the MDP into a markov chain, absorbed when the
+    adventurer enters the start with the treasure (won) or dies. Its
+    fundamental matrix gives, with a single sparse linear solve (three right
+    hand sides), the probability to win, to die and the expected number of
+    steps from every state: no game is played.
+
+    The states that can't be absorbed anymore (the policy loops forever)
+    never win nor die, and the games going through them never end.
+    """
+
+    def __init__(self, T, index: StateIndex, space: StateSpace, policy: np.array):
+        """
+        @param T: the transition model, restricted to index (MDP.T for instance)
+        @param index: StateIndex= the states of T
+        @param space: StateSpace= the states of the dungeon
+        @param policy: array of N actions (deterministic policy), or N x 4
+                       array of the probabilities of the actions
+        """
+        n_states = len(index)
+        states = np.arange(n_states)
+        if policy.ndim == 1:
+            Ts = T.policy(policy)
+        else:
+            Ts = sum(sparse.diags(policy[:, a]).dot(T.rows(a, states))
+                     for a in range(T.n_actions)).tocsr()
+        # ─────────────────── absorbing states, transient ──────────────────── #
+        won = index.compact(space.encode(np.arange(space.swords), 2, space.start))
+        won = won[won >= 0] # back to start with the treasure
+        death = n_states - 1 # always the last one (see StateIndex)
+        absorbing = np.zeros(n_states, bool)
+        absorbing[won] = absorbing[death] = True
+        self.transient = np.flatnonzero(~absorbing)
+        self.start = int(np.searchsorted(self.transient, index.compact(space.start)))
+        rows = Ts[self.transient]
+        self.Q = rows[:, self.transient].tocsr() # transient → transient
+        self.b_won = np.asarray(rows[:, won].sum(axis=1)).ravel()
+        self.b_dead = rows[:, death].toarray().ravel()
+        # ────── the states still absorbed, with a positive probability ────── #
+        absorbed = (self.b_won + self.b_dead) > 0
+        while True:
+            reach = absorbed | (self.Q.dot(absorbed.astype(np.float64)) > 0)
+            if (reach == absorbed).all(): break
+            absorbed = reach
+        # ──────────── one solve: (I - Q) [h_won, h_dead, t] = b ───────────── #
+        kept = np.flatnonzero(absorbed)
+        A = sparse.identity(len(kept), format='csc') - self.Q[kept][:, kept].tocsc()
+        b = np.column_stack([self.b_won[kept], self.b_dead[kept], np.ones(len(kept))])
+        X = np.zeros((len(self.transient), 3))
+        if len(kept):
+            X[kept] = spsolve(A, b).reshape(len(kept), 3)
+        self.p_won, self.p_dead, self.steps = X.T # from every transient state
+        ends = np.abs(self.p_won + self.p_dead - 1) < 1e-9 # surely absorbed
+        self.steps[~ends] = np.inf
+
+    @staticmethod
+    def of(agent):
+        """
+        Analysis of the policy of an agent: the deterministic policy of an MDP
+        agent, the softmax policy of a Q-learning agent (see Qlearning.policy)
+        or the uniform policy of a random agent
+        """
+        dungeon = agent.dungeon
+        if isinstance(agent, MDP):
+            T = agent.T if hasattr(agent.T, 'rows') else dungeon.make_transition_matrix().restrict(agent.index)
+            return PolicyAnalysis(T, agent.index, agent.space, agent.P)
+        index = dungeon.state_index # with the model of the map, built once
+        T = dungeon.model[0].restrict(index)
+        if isinstance(agent, AdventurerLearning):
+            policy = Qlearning.distributions(agent.Q[agent.index.compact(index.states)])
+        else:
+            assert isinstance(agent, RandomAdventurer), "no policy to analyse"
+            policy = np.full((len(index), T.n_actions), 1 / T.n_actions)
+        return PolicyAnalysis(T, index, agent.space, policy)
+
+    # ─────────────────────── results, from the start ──────────────────────── #
+    @property
+    def win(self):
+        """ probability to win a game """
+        return float(self.p_won[self.start])
+
+    @property
+    def death(self):
+        """ probability to die """
+        return float(self.p_dead[self.start])
+
+    @property
+    def expected_steps(self):
+        """ expected length of a game (inf if it might never end) """
+        return float(self.steps[self.start])
+
+    def steps_distribution(self, horizon: int):
+        """
+        @param horizon: int= maximum number of steps
+        @return won, dead: two arrays of horizon + 1, the probability to win /
+                to die at exactly t steps
+        """
+        won, dead = np.zeros(horizon + 1), np.zeros(horizon + 1)
+        d = np.zeros(len(self.transient)) # distribution of the running games
+        d[self.start] = 1
+        QT = self.Q.T.tocsr()
+        for t in range(1, horizon + 1):
+            won[t], dead[t] = d.dot(self.b_won), d.dot(self.b_dead)
+            d = QT.dot(d)
+        return won, dead
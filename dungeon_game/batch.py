@@ -0,0 +1,167 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .dungeon_map import Cell
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+class BatchDungeon(object):
+    """
+    K episodes of the same dungeon, played at once.
+
+    Every episode is a row of a few arrays (position, sword, treasure, alive,
+    over, won), and a single call to step advances all of them, following the
+    semantics of Dungeon.enter (without the captions). The random draws and
+    the teleportations are vectorized as well, so that evaluating a policy
+    runs millions of steps per second instead of thousands.
+
+    Closed groups of moving platforms, that never lead anywhere else, keep the
+    adventurer on them (as in the transition model) instead of cycling forever.
+    """
+
+    def __init__(self, dungeon, k: int, seed: int= None):
+        """
+        @param dungeon: Dungeon= the dungeon to play (its map is copied)
+        @param k: int= number of episodes played at once
+        @param seed: seed of the random generator, for reproducible runs
+        """
+        self.k = k
+        self.n, self.m = dungeon.n, dungeon.m
+        self.space = dungeon.space
+        self.p_enemy = dungeon.p_enemy
+        self.rng = np.random.default_rng(seed)
+        # ──────────────── lookup tables of the map, per cell ──────────────── #
+        n_cells = self.n * self.m
+        self.start = n_cells - 1
+        grid = np.array(list(dungeon.map))
+        self.cells = {cell: grid == cell for cell in Cell} # masks of each type
+        self.moves = dungeon.map.next_positions()
+        free = grid != Cell.wall
+        self.free = np.flatnonzero(free)
+        # cells teleporting when entered (the closed platforms don't)
+        self.teleports = np.zeros(n_cells, bool)
+        self.teleports[dungeon.make_sparse_teleports()[0]] = True
+        # neighbours of the platforms: every adjacent cell but the walls
+        neighbors = self.moves.T
+        self.valid = (neighbors != np.arange(n_cells)[:, None]) & free[neighbors]
+        # ────────────────────── state of the episodes ─────────────────────── #
+        self.position = np.full(k, self.start)
+        self.sword = np.zeros(k, bool)
+        self.treasure = np.zeros(k, np.int64) # 1: key, 2: key and treasure
+        self.alive = np.ones(k, bool)
+        self.over = np.zeros(k, bool)
+        self.won = np.zeros(k, bool)
+        self.steps = np.zeros(k, np.int64)
+
+    # ───────────────────────────── new episodes ───────────────────────────── #
+    def reset(self, episodes: np.array= None):
+        """
+        Restarts some episodes (every episode if None) from the start, without
+        any item
+        """
+        episodes = slice(None) if episodes is None else episodes
+        self.position[episodes] = self.start
+        self.sword[episodes] = False
+        self.treasure[episodes] = 0
+        self.alive[episodes] = True
+        self.over[episodes] = False
+        self.won[episodes] = False
+        self.steps[episodes] = 0
+
+    @property
+    def states(self):
+        """ complete ids of the states of the episodes (see StateSpace) """
+        return self.space.encode(self.sword, self.treasure, self.position)
+
+    # ────────────────────────── play every episode ────────────────────────── #
+    def step(self, actions: np.array):
+        """
+        Moves the adventurer of every running episode
+
+        @param actions: array of K actions (see Direction.to_int), ignored for
+                        the episodes that are over
+        @return array of K rewards, as returned by Dungeon.move
+        """
+        rewards = np.zeros(self.k)
+        playing = np.flatnonzero(~self.over)
+        self.steps[playing] += 1
+        self.position[playing] = self.moves[np.asarray(actions)[playing], self.position[playing]]
+        # ───────── enter the cells, again after every teleportation ───────── #
+        entering = playing
+        while len(entering):
+            entering = self.enter(entering, rewards)
+        return rewards
+
+    def enter(self, episodes: np.array, rewards: np.array):
+        """
+        Enters the cell of the position of some episodes (see Dungeon.enter)
+
+        @param episodes: array of the episodes entering their cell
+        @param rewards: array of K rewards, updated inplace
+        @return array of the episodes teleported, to enter their new cell
+        """
+        e, position = episodes, self.position[episodes]
+        on = lambda cell: self.cells[cell][position]
+        sword, treasure = self.sword[e], self.treasure[e]
+        u = self.rng.random(len(e))
+        dies = np.zeros(len(e), bool)
+        to_start = np.zeros(len(e), bool)
+        reward = np.zeros(len(e))
+        # -------------- walls bounce back to starting position -------------- #
+        to_start |= on(Cell.wall)
+        # ---------------- items are treated in the same way ----------------- #
+        picked = (on(Cell.magic_sword) & ~sword)
+        self.sword[e[picked]] = True
+        reward[picked] = 0.5
+        key = on(Cell.golden_key) & (treasure == 0)
+        # ------------------ treasure is particular, though ------------------ #
+        got = on(Cell.treasure) & (treasure == 1)
+        self.treasure[e[key]] = 1
+        self.treasure[e[got]] = 2
+        reward[key | got] = 0.5
+        # ---------------------- oh, CRACK, you're dead ---------------------- #
+        dies |= on(Cell.crack)
+        # ----------------------- care, it's a trap !! ----------------------- #
+        trap = on(Cell.trap)
+        dies |= trap & (u < 0.1)
+        to_start |= trap & (0.1 <= u) & (u < 0.4)
+        # ----------------------------- FIGHT !! ----------------------------- #
+        dies |= on(Cell.enemy_normal) & ~sword & (u >= self.p_enemy)
+        dies |= on(Cell.enemy_special) & sword & (u <= self.p_enemy)
+        # ------------ returning to the start (with the treasure) ------------ #
+        victory = on(Cell.start) & (treasure == 2)
+        self.won[e[victory]] = True
+        reward[victory] = 1
+        self.alive[e[dies]] = False
+        self.over[e[dies | victory]] = True
+        reward[dies] = -1
+        # ------------ magic portal and moving platforms teleport ------------ #
+        moving = self.teleports[position]
+        portal = moving & on(Cell.magic_portal)
+        platform = moving & on(Cell.moving_platform)
+        self.position[e[to_start]] = self.start
+        self.position[e[portal]] = self.free[self.rng.integers(len(self.free), size=portal.sum())]
+        if platform.any():
+            valid = self.valid[position[platform]]
+            r = np.floor(u[platform] * valid.sum(1))
+            choice = np.argmax(np.cumsum(valid, 1) > r[:, None], 1)
+            self.position[e[platform]] = self.moves[choice, position[platform]]
+        teleported = to_start | portal | platform
+        rewards[e[~teleported]] = reward[~teleported]
+        return e[teleported]
+
+    # ────────────────────────── evaluate a policy ─────────────────────────── #
+    def run(self, policy, max_steps: int= 10000):
+        """
+        Plays every episode until it is over (or max_steps are played)
+
+        @param policy: function (array of complete state ids, random generator)
+                       → array of actions (see Adventurer.play_batch)
+        @return wins, steps: two arrays of K
+                    - wins: True if the episode was won
+                    - steps: number of steps played in the episode
+        """
+        self.reset()
+        for _ in range(max_steps):
+            if self.over.all():
+                break
+            self.step(policy(self.states, self.rng))
+        return self.won.copy(), self.steps.copy()
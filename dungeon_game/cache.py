@@ -0,0 +1,122 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .transitions import FactoredTransition
+from scipy import sparse
+import numpy as np, os, shutil, hashlib
+# ──────────────────────────────────────────────────────────────────────────── #
+
+class ModelCache(object):
+    """
+    Persistent cache of the transition and reward models of the dungeons.
+
+    Every model is stored in its own directory of .npy files, named after a
+    hash of the map (size and cells) and of the parameters of the model, so
+    that the transition matrices can be memory-mapped when loaded again.
+    The cache is bounded in size: the least recently used models are evicted.
+    """
+
+    version = 2 # to change whenever the way models are built changes
+
+    def __init__(self, directory: str= None, max_size: int= 512 * 2 ** 20):
+        """
+        @param directory: where the models are stored [default: ~/.cache/dungeon_game]
+        @param max_size: maximum size of the cache, in bytes
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'dungeon_game')
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    # ─────────────────────── key identifying a model ──────────────────────── #
+    def key(self, dungeon):
+        """ hash of everything the model depends on """
+        d_map = dungeon.map
+        content = '{}|{},{}|{}|{}|{},{}'.format(
+                ModelCache.version, d_map.n, d_map.m,
+                ''.join(cell.to_save() for cell in d_map),
+                repr(float(dungeon.p_enemy)), dungeon.space.swords, dungeon.space.treasures)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def path(self, key: str):
+        return os.path.join(self.directory, key)
+
+    # ───────────────────────── load / store models ────────────────────────── #
+    def load(self, dungeon):
+        """
+        @return T, R: the cached models of the dungeon, None if not cached
+                the transition matrices are memory-mapped (read-only)
+        """
+        path = self.path(self.key(dungeon))
+        if not os.path.isdir(path):
+            return None
+        try:
+            load = lambda name, **kw: np.load(os.path.join(path, name + '.npy'), **kw)
+            csr = lambda name, size: sparse.csr_matrix(
+                    (load(name + '_data', mmap_mode='r'),
+                     load(name + '_indices', mmap_mode='r'),
+                     load(name + '_indptr', mmap_mode='r')), shape=(size, size))
+            n_cells = dungeon.n * dungeon.m
+            moves = [csr('G{}'.format(a), n_cells) for a in range(4)]
+            S = csr('S', dungeon.space.n_states)
+            R = load('R')
+            positions, distribs = load('teleport_positions'), load('teleport')
+        except (OSError, ValueError):
+            return None # incomplete or corrupted entry
+        os.utime(path) # most recently used
+        teleport_distributions = dict(zip(positions.tolist(), distribs))
+        grid = np.array(list(dungeon.map)).reshape(dungeon.n, dungeon.m)
+        return FactoredTransition(moves, S, grid, teleport_distributions), R
+
+    def store(self, dungeon, T: FactoredTransition, R: np.array):
+        """ stores the models of the dungeon, then evicts the oldest models """
+        key = self.key(dungeon)
+        path = self.path(key)
+        if os.path.isdir(path):
+            return
+        tmp = path + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        save = lambda name, array: np.save(os.path.join(tmp, name + '.npy'), array)
+        def save_csr(name, M):
+            save(name + '_data', M.data)
+            save(name + '_indices', M.indices)
+            save(name + '_indptr', M.indptr)
+        for (a, G) in enumerate(T.moves):
+            save_csr('G{}'.format(a), G)
+        save_csr('S', T.S)
+        save('R', R)
+        positions = sorted(T.teleport_distributions)
+        save('teleport_positions', np.array(positions, np.int64))
+        save('teleport', np.array([T.teleport_distributions[p] for p in positions])
+                         .reshape(len(positions), dungeon.n * dungeon.m))
+        try:
+            os.rename(tmp, path) # atomic: never expose a partial entry
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True) # stored concurrently
+        self.evict(keep=key)
+
+    # ─────────────────────────── size-bounded LRU ─────────────────────────── #
+    def entries(self):
+        """ @return list of (last use, size in bytes, key), oldest first """
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.path(key)
+            if not os.path.isdir(path) or '.tmp' in key:
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, key))
+        return sorted(entries)
+
+    def evict(self, keep: str= None):
+        """ removes the least recently used models until the cache fits """
+        entries = self.entries()
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, key) in entries:
+            if total <= self.max_size:
+                break
+            if key != keep:
+                shutil.rmtree(self.path(key), ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        for (_, _, key) in self.entries():
+            shutil.rmtree(self.path(key), ignore_errors=True)
@@ -3,13 +3,18 @@ import csv
 
 from .dungeon_map import Direction, Cell
 from .utils import vprint
-from .states import State
+from .states import State, StateIndex
 import numpy as np, random
 # ──────────────────────────────────────────────────────────────────────────── #
 # ──────────────────────────────── adventurer ──────────────────────────────── #
 class Adventurer(object):
     """ Adventurer for the MDP game. """
 
+    # ─────────────────── items, as a bitmask of the cells ─────────────────── #
+    item_bits = {Cell.magic_sword: 1, Cell.golden_key: 2, Cell.treasure: 4}
+    blocks = [0, 3, 1, 4, 2, 5, 2, 5] # items → sword * treasures + treasure (see State)
+    block_items = [0, 2, 6, 1, 3, 7] # and back
+
     def __init__(self, dungeon, name='Indiana'):
         """
         Initializes an adventurer at position (i, j)
@@ -20,25 +25,54 @@ class Adventurer(object):
         self.alive = True
         self.dungeon = dungeon
         self.i, self.j = self.dungeon.n - 1, self.dungeon.m - 1
-        self.__items = []
+        self.items = 0 # bitmask, see item_bits
+        # states of the tables of the agent: every state, the model-based
+        # agents keeping the reachable ones only (see MDP)
+        self.index = StateIndex.full(self.space.n_states)
 
     def reset(self):
-        self.__items = []
+        self.items = 0
         self.alive = True
         self.pos = (self.dungeon.n - 1, self.dungeon.m - 1)
+        if self.index.n_states != self.space.n_states: # a map of another size
+            self.index = StateIndex.full(self.space.n_states)
 
     def soft_reset(self):
-        self.__items = []
+        self.items = 0
         self.alive = True
         self.pos = (self.dungeon.n - 1, self.dungeon.m - 1)
 
     # ───────────────────────── getter for the state ───────────────────────── #
     @property
     def state(self):
-        treasure = 0
-        if self.has_item(Cell.golden_key): treasure = 1
-        if self.has_item(Cell.treasure): treasure = 2
-        return State(self.has_item(Cell.magic_sword), treasure, self.cell_id)
+        """ current state, its index being its id in the tables of the agent """
+        state = State(s_id=self.s_id, space=self.space)
+        state.index = self.compact_id
+        return state
+
+    @property
+    def s_id(self):
+        """ complete id of the current state, without building a State """
+        return self.block * self.space.cells + self.i * self.dungeon.m + self.j
+
+    @property
+    def space(self):
+        """ the states of the dungeon played (see StateSpace) """
+        return self.dungeon.space
+
+    @property
+    def block(self):
+        """ items as in the state ids: sword * treasures + treasure """
+        return Adventurer.blocks[self.items]
+
+    @block.setter
+    def block(self, value: int):
+        self.items = Adventurer.block_items[value]
+
+    @property
+    def compact_id(self):
+        """ id of the current state in the tables of the agent (see index) """
+        return int(self.index.index[self.s_id])
 
     # ────────────────────────── getter for cell id ────────────────────────── #
     @property
@@ -61,14 +95,14 @@ class Adventurer(object):
 
     # ─────────────── methods changing the state of the agent ──────────────── #
     def acquire_item(self, item):
-        if item in self.__items:
+        if self.has_item(item):
             vprint("Player {} can't acquire {}, he already has one".format(
                 self, item))
         else:
-            self.__items.append(item)
+            self.items |= Adventurer.item_bits[item]
 
     def has_item(self, item):
-        return item in self.__items
+        return bool(self.items & Adventurer.item_bits.get(item, 0))
 
     # ─────────────────────── decision making methods ──────────────────────── #
     def play(self, state):
@@ -79,9 +113,29 @@ class Adventurer(object):
         """
         return Direction.NORTH
 
-    def process_reward(self, oldState: State, newState: State, action: Direction,
+    def play_batch(self, states: np.array, rng: np.random.Generator= None):
+        """
+        Decides the actions of many episodes at once (see BatchDungeon)
+
+        @param states: array of complete state ids
+        @param rng: random generator of the random decisions (numpy's if None)
+        @return array of actions (see Direction.to_int)
+        """
+        compact = self.index.compact(states)
+        actions = np.zeros(len(states), np.int64)
+        for (h, s_id) in enumerate(states):
+            state = State(s_id=s_id, space=self.space)
+            state.index = int(compact[h])
+            actions[h] = self.play(state).to_int
+        return actions
+
+    def process_reward(self, old_state: int, new_state: int, action: Direction,
             reward: float):
-        """ The agent processes the reward obtained while performing an action """
+        """
+        The agent processes the reward obtained while performing an action
+
+        @param old_state, new_state: compact ids of the states (see compact_id)
+        """
         pass
 
     # ──────────────────────────── magic methods ───────────────────────────── #
@@ -93,7 +147,8 @@ class Adventurer(object):
     def infos(self):
         return '{} items {} [{}]'.format(
                 self.name,
-                '{ ' + ' , '.join([item.value for item in self.__items]) + ' }',
+                '{ ' + ' , '.join([item.value for item in Adventurer.item_bits
+                                   if self.has_item(item)]) + ' }',
                 'ALIVE' if self.alive else 'DEAD')
 
 # ─────────────────────────────── random agent ─────────────────────────────── #
@@ -101,20 +156,28 @@ class RandomAdventurer(Adventurer):
     def play(self, state: State):
         return random.choice(list(Direction))
 
+    def play_batch(self, states: np.array, rng: np.random.Generator= None):
+        if rng is None:
+            return np.random.randint(len(Direction), size=len(states))
+        return rng.integers(len(Direction), size=len(states))
+
 # ───────────────────────────── q-learning agent ───────────────────────────── #
 class AdventurerLearning(Adventurer):
 
     def __init__(self, dungeon, name='Remi'):
         super().__init__(dungeon)
-        self.Q = np.zeros((State.max_id, 4))
+        self.Q = np.zeros((len(self.index), 4))
 
     def play(self, state: State):
-        return Qlearning.policy(self.Q, state)
+        return Qlearning.policy(self.Q, state.index)
+
+    def play_batch(self, states: np.array, rng: np.random.Generator= None):
+        return Qlearning.policies(self.Q, self.index.compact(states), rng)
 
     def policy(self):
-        return Qlearning.policy(self.Q, self.state)
+        return Qlearning.policy(self.Q, self.compact_id)
 
-    def process_reward(self, old_state: State, new_state: State, action: Direction, reward: float):
+    def process_reward(self, old_state: int, new_state: int, action: Direction, reward: float):
         """ The agent processes the reward obtained while performing an action """
         self.Q = Qlearning.update(self.Q, old_state, new_state, action, reward)
         pass
@@ -123,25 +186,30 @@ class AdventurerLearning(Adventurer):
         self.Q = tab
 
     def reset_Qtable(self):
-        self.Q = np.zeros((State.max_id, 4))
+        self.Q = np.zeros((len(self.index), 4))
 
     def load_Qtable_from_file(self, path: str):
+        """ Q-tables are saved on the complete ids, death excepted (see save_Qtable) """
         try:
             with open(path, "r") as csv_file:
                 csv_reader = csv.reader(csv_file, delimiter=',')
-                self.Q = np.zeros((1, 4))
+                Q = np.zeros((1, 4))
                 for row in csv_reader:
                     row = [float(i) for i in row]
-                    self.Q = np.vstack([self.Q, row])
-            self.Q = np.delete(self.Q, (0), axis=0)
-            assert State.max_id == len(self.Q), "Q_table size don't fit with map"
+                    Q = np.vstack([Q, row])
+            Q = np.delete(Q, (0), axis=0)
+            assert self.space.max_id == len(Q), "Q_table size don't fit with map"
+            Q = np.vstack([Q, np.zeros((1, 4))]) # death
+            self.Q = self.index.gather(Q)
         except FileNotFoundError:
             print("File to load don't exist !")
 
     def save_Qtable(self, path):
+        """ saves the Q-table on the complete ids, death excepted """
+        Q = self.index.scatter(self.Q)[:self.space.max_id]
         with open(path, 'w',  newline='') as csvFile:
             writer = csv.writer(csvFile)
-            writer.writerows(self.Q)
+            writer.writerows(Q)
 
 # ───────────────────────────── q-learning class ───────────────────────────── #
 class Qlearning(object):
@@ -149,12 +217,25 @@ class Qlearning(object):
     learning_rate = 0.1
     gamma = 0.7
 
-    def policy(q_table: float, state: State):
-        row = q_table[state.id]
+    def policy(q_table: float, index: int):
+        """ action drawn for the compact state id index """
+        row = q_table[index]
         softmax_distribution = Qlearning.softmax(row)
         result = Qlearning.random_index(softmax_distribution)
         return Direction.from_int(result)
 
+    def policies(q_table: float, indexes: np.array, rng: np.random.Generator= None):
+        """ vectorized policy, for an array of compact state ids """
+        P = np.cumsum(Qlearning.distributions(q_table[indexes]), axis=1)
+        u = np.random.random((len(P), 1)) if rng is None else rng.random((len(P), 1))
+        return np.argmax(P > u, axis=1)
+
+    def distributions(q_table: float):
+        """ softmax distributions of the actions, for every row of q_table """
+        Q = q_table * Qlearning.beta
+        P = np.exp(Q - Q.max(axis=1, keepdims=True))
+        return P / P.sum(axis=1, keepdims=True)
+
     def softmax(array):
         values = np.zeros(len(array))
         sum_array = 0.0
@@ -173,14 +254,15 @@ class Qlearning(object):
             i += 1
         return i - 1
 
-    def update(q_table: float, old_state: State, new_state: State, action: Direction, reward: float):
-        currentRow = np.sort(q_table[new_state.id].copy())
+    def update(q_table: float, old_state: int, new_state: int, action: Direction, reward: float):
+        """ @param old_state, new_state: compact ids of the states """
+        currentRow = np.sort(q_table[new_state].copy())
 
         action_index = action.to_int
-        delta = reward + Qlearning.gamma * currentRow[len(currentRow) - 1] - q_table[old_state.id][action_index]
+        delta = reward + Qlearning.gamma * currentRow[len(currentRow) - 1] - q_table[old_state][action_index]
 
-        q_table[old_state.id][action_index] += Qlearning.learning_rate * delta
-        q_table[old_state.id][action_index] = round(q_table[old_state.id][action_index], 6)
+        q_table[old_state][action_index] += Qlearning.learning_rate * delta
+        q_table[old_state][action_index] = round(q_table[old_state][action_index], 6)
 
         return q_table
 
@@ -3,6 +3,7 @@
 from enum import Enum
 from random import choice as rchoice, randint
 from numpy.random import choice as npchoice
+import numpy as np
 # ─────────────────────────── Cardinal Directions ──────────────────────────── #
 class Direction(Enum):
     NORTH = (-1, 0)
@@ -12,15 +13,18 @@ class Direction(Enum):
 
     @property
     def reverse(self):
-        return list(Direction)[(self.to_int + 2) % 4]
+        return directions[(self.to_int + 2) % 4]
 
     @property
     def to_int(self):
-        return list(Direction).index(self)
+        return direction_ints[self]
 
     @staticmethod
     def from_int(value: int):
-        return list(Direction)[int(value)]
+        return directions[int(value)]
+
+directions = tuple(Direction) # int → Direction
+direction_ints = {d: h for (h, d) in enumerate(directions)} # Direction → int
 
 # ─────────────────────────────── Cells Types ──────────────────────────────── #
 class Cell(Enum):
@@ -86,6 +90,8 @@ class DungeonMap(object):
         """
         self.n, self.m = n, m
         self.default = new_env
+        self.version = 0 # incremented at every change of the layout
+        self.__checked = -1 # version whose winnability is known
         self.__grid = [Cell.empty for i in range(self.n * self.m)]
         self[0, 0] = Cell.treasure
         self[n - 1, m - 1] = Cell.start
@@ -170,6 +176,18 @@ class DungeonMap(object):
             if (ni, nj) != (i, j):
                 yield ((ni, nj), direction)
 
+    # ───────────── every move of every cell, as a lookup table ────────────── #
+    def next_positions(self):
+        """
+        @return array 4 x (n * m): the position (cell id) reached from each
+                cell by moving in each direction (see Direction.to_int)
+        """
+        n, m = self.n, self.m
+        i, j = np.divmod(np.arange(n * m), m)
+        moves = [np.clip(i + di, 0, n - 1) * m + np.clip(j + dj, 0, m - 1)
+                 for (di, dj) in (d.value for d in Direction)]
+        return np.stack(moves)
+
     # ────────────────────────── manhattan distance ────────────────────────── #
     def distance(self, A: (int, int), B: (int, int)):
         """ Returns the Manhattan distance between A and B """
@@ -185,10 +203,11 @@ class DungeonMap(object):
         return (ni, nj)
 
     # ────────────────────── generate a random dungeon ─────────────────────── #
-    def generate_map(self):
+    def generate_map(self, rng: np.random.Generator= None):
         """
         Generates a list of cells to be loaded as a layout
 
+        @param rng: random generator of the layout (the global ones if None)
         @return a grid of Cell enums randomly generated
         """
         n, m = self.n, self.m
@@ -198,7 +217,7 @@ class DungeonMap(object):
         grid[n * m - 1] = Cell.start
         required = [Cell.golden_key, Cell.magic_sword]
         while len(required) > 0:
-            h = randint(1, n * m - 2)
+            h = randint(1, n * m - 2) if rng is None else int(rng.integers(1, n * m - 1))
             if grid[h] == '': grid[h] = required.pop()
 
         cell_p = [
@@ -226,7 +245,7 @@ class DungeonMap(object):
         cells = [cell for (cell, _) in cell_p]
         distrib = [p for (_, p) in cell_p]
         for h in range(n * m):
-            cell = npchoice(cells, p=distrib)
+            cell = npchoice(cells, p=distrib) if rng is None else cells[rng.choice(len(cells), p=distrib)]
             if grid[h] == '': grid[h] = cell
 
         assert self.valid(grid)
@@ -240,8 +259,12 @@ class DungeonMap(object):
     def load(self, snapshot):
         """ Loads a snapshot (list of cells) of a dungeon of same size """
         assert len(snapshot) == self.n * self.m
+        if snapshot is not self.__grid: # a reset may reload the same layout
+            self.version += 1
         self.__grid = snapshot
-        self.winnable = self.__is_winnable(portals=False)
+        if self.__checked != self.version:
+            self.winnable = self.__is_winnable(portals=False)
+            self.__checked = self.version
 
     def load_as_main(self, d_map):
         self.init_map = d_map
@@ -258,6 +281,7 @@ class DungeonMap(object):
                 self.n, self.m = [int(x) for x in line.split(',')]
                 line = file.readline()
                 self.__grid = [Cell.to_load(c) for c in line]
+                self.version += 1
         except FileNotFoundError:
             print("File to load don't exist !")
         self.init_map = self.__grid
@@ -276,6 +300,7 @@ class DungeonMap(object):
         raise IndexError
 
     def __setitem__(self, indexes, value):
+        self.version += 1
         if isinstance(indexes, (list, tuple)) and len(indexes) == 2:
             self.__grid[indexes[0] * self.m + indexes[1]] = value
         elif isinstance(indexes, (int, slice)):
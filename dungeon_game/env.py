@@ -0,0 +1,122 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .kernel import Dungeon
+from random import Random
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+class VecDungeonEnv(object):
+    """
+    K dungeons played at once, gym style, on integer state ids.
+
+    Every environment is stepped with Dungeon.step, with its own random
+    streams: the observations are complete state ids (see StateSpace), and the
+    episodes that end are restarted at once (auto-reset), the state they
+    ended in being returned in the infos of step. No Adventurer is involved.
+
+    The environments share a single map (fixed), or each of them plays a
+    freshly generated map at every reset (new_map).
+    """
+
+    def __init__(self, k: int, n: int= None, m: int= None, dungeon: Dungeon= None,
+            new_map: bool= False, new_env: bool= True, seed= None, max_steps: int= None):
+        """
+        @param k: int= number of environments
+        @param n, m: size of the maps (the size of dungeon if None)
+        @param dungeon: Dungeon= the map played by every environment, when not
+                        new_map (a random map if None)
+        @param new_map: bool= generate a new map for every episode
+        @param new_env: bool= kind of the maps generated (see DungeonMap)
+        @param seed: seed of the random streams, an int spawning one stream
+                     per environment or a list of k ints (random if None)
+        @param max_steps: the episodes still running after max_steps are
+                          over (truncated), never if None
+        """
+        self.k, self.new_map = k, new_map
+        self.max_steps = max_steps
+        self.n, self.m = (n, m) if dungeon is None else (dungeon.n, dungeon.m)
+        self.seed(seed)
+        # ─────── one dungeon per environment, or the same one for all ─────── #
+        # (copies of dungeon, whose random streams are replaced while playing)
+        self.dungeons = [Dungeon(self.n, self.m, 0, new_env=new_env)
+                         for _ in range(k if new_map else 1)]
+        for copy in self.dungeons:
+            copy.p_enemy = Dungeon.p_enemy if dungeon is None else dungeon.p_enemy
+        if new_map: # the first maps, from the streams of the environments
+            for h in range(k):
+                self.generate(h)
+        else:
+            if dungeon is None:
+                self.generate(0)
+            else:
+                self.dungeons[0].map.load_as_main(dungeon.map.snapshot())
+            self.dungeons *= k
+        self.space = self.dungeons[0].space
+        self.start = self.space.start
+        self.states = np.full(k, self.start, np.int64)
+        self.steps = np.zeros(k, np.int64)
+
+    def seed(self, seed= None):
+        """
+        @param seed: an int spawning one stream per environment, a list of
+                     k ints, or None (random)
+        """
+        if seed is None or np.ndim(seed) == 0:
+            seeds = np.random.SeedSequence(seed).spawn(self.k)
+        else:
+            assert len(seed) == self.k, "one seed per environment"
+            seeds = [np.random.SeedSequence(s) for s in seed]
+        self.rngs = [np.random.default_rng(s) for s in seeds] # maps
+        self.randoms = [Random(int(s.generate_state(1)[0])).random for s in seeds] # steps
+
+    # ───────────────────────────── new episodes ───────────────────────────── #
+    def reset(self, envs: np.array= None):
+        """
+        Restarts some environments (every one if None) from the start, on a
+        new map if new_map
+
+        @return array of the k states
+        """
+        envs = range(self.k) if envs is None else envs
+        for h in envs:
+            if self.new_map:
+                self.generate(h)
+            self.states[h] = self.start
+            self.steps[h] = 0
+        return self.states.copy()
+
+    def generate(self, h: int):
+        """ Generates a new (winnable) map for the environment h """
+        dungeon = self.dungeons[h]
+        while True:
+            dungeon.map.load_as_main(dungeon.map.generate_map(self.rngs[h]))
+            if dungeon.winnable: break
+
+    # ──────────────────────── play every environment ──────────────────────── #
+    def step(self, actions: np.array):
+        """
+        @param actions: array of k actions (see Direction.to_int)
+        @return states, rewards, dones, infos:
+                    - states: array of k states (restarted if done)
+                    - rewards: array of k rewards
+                    - dones: array of k bools, the episode is over
+                    - infos: dict of arrays of k
+                        - 'final_states': the states reached by the actions
+                        - 'won': the episode was won
+                        - 'truncated': the episode ran out of steps
+        """
+        actions = np.asarray(actions).tolist()
+        rewards = np.zeros(self.k)
+        dones = np.zeros(self.k, bool)
+        final = np.zeros(self.k, np.int64)
+        for h in range(self.k):
+            dungeon = self.dungeons[h]
+            dungeon.random = self.randoms[h]
+            final[h], rewards[h], dones[h] = dungeon.step(int(self.states[h]), actions[h])
+        self.states[:] = final
+        self.steps += 1
+        won = dones & (final != self.space.max_id)
+        truncated = ~dones & (self.steps >= self.max_steps) if self.max_steps else np.zeros(self.k, bool)
+        dones |= truncated
+        self.reset(np.flatnonzero(dones))
+        infos = {'final_states': final, 'won': won, 'truncated': truncated}
+        return self.states.copy(), rewards, dones, infos
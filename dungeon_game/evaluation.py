@@ -0,0 +1,57 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .mdp import MDP
+from .batch import BatchDungeon
+from .simulator import ModelSimulator
+from multiprocessing import Pool
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+def play_shard(job):
+    """
+    Plays a shard of the episodes, in a worker process
+
+    @param job: (engine, policy, k, max_steps, seed), see evaluate
+    @return wins, steps: two arrays of k
+    """
+    engine, policy, k, max_steps, seed = job
+    if isinstance(engine, ModelSimulator):
+        return engine.run(policy, k, max_steps, seed)
+    engine.rng = np.random.default_rng(seed)
+    return engine.run(policy, max_steps)
+
+def evaluate(dungeon, iterations: int, jobs: int= 1, seed: int= None,
+        max_steps: int= 10000):
+    """
+    Evaluates the (single) agent of a dungeon, over many games
+
+    The games are played on the compiled model for the MDP agents (see
+    ModelSimulator), else in the game itself (see BatchDungeon). They are split
+    in one shard per job, played by a pool of processes, every shard with its
+    own random stream spawned from the seed: the results only depend on the
+    seed and the number of jobs.
+
+    @param iterations: int= number of games played
+    @param jobs: int= number of worker processes
+    @param seed: seed of the random streams (random results if None)
+    @param max_steps: the games still running after max_steps are lost
+    @return wins, steps: two arrays of iterations, in the order of the shards
+                - wins: True if the game was won
+                - steps: number of steps played in the game
+    """
+    assert len(dungeon.agents) == 1
+    agent, = dungeon.agents
+    seeds = np.random.SeedSequence(seed).spawn(jobs)
+    sizes = [len(shard) for shard in np.array_split(np.arange(iterations), jobs)]
+    if isinstance(agent, MDP) and not agent.matrix_free:
+        simulator = ModelSimulator(agent.T, agent.index, agent.space)
+        shards = [(simulator, agent.P, k, max_steps, s) for (k, s) in zip(sizes, seeds)]
+    else:
+        shards = [(BatchDungeon(dungeon, k), agent.play_batch, k, max_steps, s)
+                  for (k, s) in zip(sizes, seeds)]
+    if jobs == 1:
+        results = [play_shard(shards[0])]
+    else:
+        with Pool(jobs) as pool:
+            results = pool.map(play_shard, shards)
+    wins, steps = zip(*results)
+    return np.concatenate(wins), np.concatenate(steps)
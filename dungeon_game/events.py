@@ -0,0 +1,99 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .dungeon_map import Direction, Cell
+from enum import IntEnum
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+# ──────────────────────── what happens in a dungeon ───────────────────────── #
+class Event(IntEnum):
+    """ Codes of the events emitted by Dungeon.enter and Dungeon.teleport """
+    teleported    = 0  # new line of the caption
+    wall          = 1
+    item_held     = 2  # args: item (see items)
+    item_picked   = 3  # args: item (see items)
+    treasure      = 4
+    portal        = 5  # args: i, j, ni, nj
+    platform      = 6  # args: di, dj
+    crack         = 7
+    trap_death    = 8
+    trap_start    = 9
+    trap_missed   = 10
+    enemy_won     = 11
+    enemy_death   = 12
+    sword         = 13
+    no_threat     = 14
+    special_fled  = 15
+    special_death = 16
+    victory       = 17
+
+items = (Cell.golden_key, Cell.magic_sword, Cell.treasure)
+
+captions = {
+    Event.teleported:    lambda: '\n',
+    Event.wall:          lambda: "Bounced against a wall ... Back to start !",
+    Event.item_held:     lambda k: "Can't pick up another {}, already have one".format(items[k].name),
+    Event.item_picked:   lambda k: "Picked up an item ({}) !!".format(items[k].name),
+    Event.treasure:      lambda: "Got the treasure !",
+    Event.portal:        lambda i, j, ni, nj: "STARGAAAATE : {} → {}".format((i, j), (ni, nj)),
+    Event.platform:      lambda di, dj: "Woops ! It moves ! (teleported to {})".format(Direction((di, dj)).name),
+    Event.crack:         lambda: "DAMN ! CRACK !!! I'm dead.",
+    Event.trap_death:    lambda: "ITS A TRAPPP I'm dead.",
+    Event.trap_start:    lambda: "ITS A TRAPPP Back to start. (tunneled :] )",
+    Event.trap_missed:   lambda: "ITS A TRAPPP But it's ineffective.",
+    Event.enemy_won:     lambda: "Enemy in sight ! Easily defeated.",
+    Event.enemy_death:   lambda: "Enemy in sight ! Woops, I'm dead",
+    Event.sword:         lambda: "BIM ! BAM ! MAGIC SWORD IN YOUR FACE !",
+    Event.no_threat:     lambda: "Not a threat for me.",
+    Event.special_fled:  lambda: "This enemy can't be slain ! I managed to flee.",
+    Event.special_death: lambda: "This enemy can't be slain ! Goodbye, sweet world",
+    Event.victory:       lambda: "I WON. !!!",
+}
+
+def render(events: list):
+    """
+    @param events: list of (code, args) as returned by EventBuffer.drain
+    @return the caption describing those events
+    """
+    return ''.join(captions[Event(code)](*args) for (code, args) in events)
+
+# ──────────────────────── ring buffer of the events ───────────────────────── #
+class EventBuffer(object):
+    """
+    Preallocated ring buffer of integer events: pushing an event never
+    allocates, and only the last `size` events are kept.
+    """
+
+    n_args = 4 # maximum number of arguments of an event
+
+    def __init__(self, size: int= 64):
+        self.size = size
+        self.codes = np.zeros(size, np.int8)
+        self.arity = np.zeros(size, np.int8)
+        self.args = np.zeros((size, self.n_args), np.int64)
+        self.count = 0 # number of events pushed since the last clear
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def push(self, code: Event, *args):
+        """ Records an event, overwriting the oldest one when full """
+        k = self.count % self.size
+        self.codes[k] = code
+        self.arity[k] = len(args)
+        self.args[k, :len(args)] = args
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def drain(self):
+        """
+        @return list of the (code, args) recorded, the oldest first, and
+                empties the buffer
+        """
+        first = self.count - len(self)
+        order = [k % self.size for k in range(first, self.count)]
+        events = [(int(self.codes[k]), tuple(int(x) for x in self.args[k, :self.arity[k]]))
+                  for k in order]
+        self.clear()
+        return events
@@ -3,9 +3,14 @@
 # ───────────────────────────────── imports ────────────────────────────────── #
 from .markov import MarkovChain
 from .characters import Adventurer, AdventurerLearning,State
+from .states import StateIndex, StateSpace
 from .dungeon_map import DungeonMap, Direction, Cell, AStar
+from .transitions import FactoredTransition, MapOperator
+from .events import Event
 from .utils import Color, color_grid
 from random import random
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
 import numpy as np
 # ──────────────────────────────────────────────────────────────────────────── #
 
@@ -14,10 +19,15 @@ class Dungeon(object):
     """ Dungeon object containing all the game logic """
 
     p_enemy = 0.7
+    model_cache = None # optional ModelCache, to reuse models across runs
+    events = None # optional EventBuffer, None for a headless dungeon
+    _step_key = None # layout of the map the step tables were built for
+    random = staticmethod(random) # random floats in [0, 1[ of the steps
 
     def __init__(self, n: int, m: int, nb_players: int = 1, player_classes: list= None, new_env: bool = True):
         self.n, self.m = n, m
-        State.configure(self.n, self.m)
+        self.space = StateSpace(n, m) # ids of the states of this dungeon
+        State.configure(self.space)
 
         # ------------------------ creating a new map ------------------------ #
         self.map = DungeonMap(n, m, new_env)
@@ -26,17 +36,18 @@ class Dungeon(object):
 
         self.last_actions = [None for i in range(nb_players)]
         self.over, self.won = False, False
-        self.caption = ''
 
         self.teleport_distributions = {}
+        self._model, self._state_index, self._index_key = None, None, None
 
         # ------------------------ generating players ------------------------ #
         player_classes = [AdventurerLearning for i in range(nb_players)] \
                 if player_classes is None else player_classes
         assert len(player_classes) >= nb_players
         self.agents = [pclass(self) for pclass in player_classes[:nb_players]]
+        self.slots = {agent: h for (h, agent) in enumerate(self.agents)} # in last_actions
 
-        State.configure(n, m)
+        State.configure(self.space)
 
     # ─────────── display a transition matric in a readable output ─────────── #
     def display_transition(self, s: State, a: Direction):
@@ -48,14 +59,75 @@ class Dungeon(object):
         tr = self.make_transition_matrix()[s.id, a.to_int]
         for (i, p) in enumerate(tr):
             if p > 0:
-                print('- {p:4.2%}: {st}'.format(p=p, st=State(s_id=i)))
+                print('- {p:4.2%}: {st}'.format(p=p, st=State(s_id=i, space=self.space)))
 
     # ───────────────────────── add agent post init ────────────────────────── #
     def add_agent(self, agent: Adventurer):
+        self.slots[agent] = len(self.agents)
         self.agents.append(agent)
+        self.last_actions.append(None)
+
+    # ─────────────── transition and reward models of the MDP ──────────────── #
+    def make_model(self, T: FactoredTransition= None, R: np.array= None):
+        """
+        @param T, R: models built for a previous layout of the map, to be
+                     updated (see update_transition_matrix)
+        @return T, R: the transition and reward models of the current map,
+                      loaded from the model cache when available
+        The states reachable on that map are indexed as well, both being kept
+        for that layout (see model, state_index)
+        """
+        cached = self.model_cache.load(self) if self.model_cache is not None else None
+        if cached is not None:
+            T, R = cached
+            self.teleport_distributions = T.teleport_distributions
+        elif T is None:
+            T = self.make_transition_matrix()
+            R = self.make_reward_matrix(T)
+        else:
+            T, states = self.update_transition_matrix(T)
+            R = self.make_reward_matrix(T, R, states)
+        if cached is None and self.model_cache is not None:
+            self.model_cache.store(self, T, R)
+        self._state_index = StateIndex.reachable(T, self.space.start)
+        self._model, self._index_key = (T, R), (id(self.map), self.map.version)
+        return T, R
+
+    def make_operator(self):
+        """
+        @return MapOperator: the matrix-free transition model of the current
+                map, for maps too large for an explicit model. The states
+                reachable are not searched (see state_index): it would need
+                the explicit model.
+        """
+        return MapOperator(np.array(list(self.map)), self.map.next_positions(),
+                           self.cell_outcomes(), self.make_sparse_teleports())
+
+    @property
+    def model(self):
+        """
+        The transition and reward models (T, R) of the current map (see
+        make_model), built when first needed and kept with the state index
+        """
+        if self._index_key != (id(self.map), self.map.version):
+            self.make_model()
+        return self._model
+
+    @property
+    def state_index(self):
+        """
+        Compact index of the states reachable on the current map (see
+        StateIndex), used by the model-based agents for their tables (values,
+        policy ...). Built with the model of the map when first needed, and
+        kept while the layout of the map doesn't change.
+        """
+        if self._index_key != (id(self.map), self.map.version):
+            self.make_model()
+        return self._state_index
 
     # ──────────────────── constructing the reward matrix ──────────────────── #
-    def make_reward_matrix(self, T: np.array):
+    def make_reward_matrix(self, T: FactoredTransition, R: np.array= None,
+            states: np.array= None):
         """
         The reward matrix is quite simple:
             - death → (*,*,*) : -1
@@ -66,256 +138,349 @@ class Dungeon(object):
         Negative reward for death
         Positive reward for (actually) picking up the key, picking up the treasure
         and returning to start with the treasure
+
+        @param R, states: to only update the rewards of some states in R (after
+                          an update of the transition model)
         """
         n, m = self.n, self.m
-        n_state = State.max_id + 1
+        n_state = self.space.n_states
         death = n_state - 1
-        R = np.zeros((n_state, 4), np.float64)
-        for sw in range(2):
-            for tr in range(3):
-                for p in range(n * m):
-                    s = State(sw, tr, p)
-                    for a in Direction:
-                        # we only reward 'certain' actions, actions with
-                        # probability 1 to lead to a state
-                        if np.amax(T[s.id, a.to_int]) == 1:
-                            certain_state = np.argmax(T[s.id, a.to_int])
-                            st = State(s_id=certain_state) # target state
-                            # -------------- (*,0,*) → (*,1,*) --------------- #
-                            #                (*  *)   (*  *)
-                            if s.treasure == 0 and st.treasure == 1:
-                                R[s.id, a.to_int] = 0.5
-                            # -------------- (*,1,*) → (*,2,*) --------------- #
-                            #                (*  *)   (* ﰤ *)
-                            if s.treasure == 1 and st.treasure == 2:
-                                R[s.id, a.to_int] = 0.5
-                            # -------------- (0,*,*) → (1,*,*) --------------- #
-                            #                ( * *)   (理* *)
-                            if s.sword == 0 and st.sword == 1:
-                                R[s.id, a.to_int] = 0.5
-                            # ---------- (*,2,start) → (*,2,start) ----------- #
-                            #            (* 2 ◉ )      (* 2 ◉ ) 
-                            if s.treasure == st.treasure == 2 and \
-                                    s.position == st.position == n * m - 1:
-                                R[s.id, a.to_int] = 1
-                            # ---------------- death → death ----------------- #
-                            if s.id == st.id == death:
-                                R[s.id, a.to_int] = -1
+        if R is None or states is None:
+            R, states = np.zeros((n_state, 4), np.float64), np.arange(n_state)
+        # we only reward 'certain' actions, actions with probability 1 to lead
+        # to a state. every state-action is processed at once, (s, a) → st
+        certain, target = T.certain(states)
+        sw, tr, p = [x[:, None] for x in self.space.decode(states)]
+        st_sw, st_tr, st_p = self.space.decode(target)
+        # death is not a real position, it never matches the rules below
+        alive = certain & (states[:, None] != death) & (target != death)
+        rewards = np.zeros((len(states), 4), np.float64)
+        # ------------------------ (*,0,*) → (*,1,*) ------------------------- #
+        #                          (*  *)   (*  *)
+        rewards[alive & (tr == 0) & (st_tr == 1)] = 0.5
+        # ------------------------ (*,1,*) → (*,2,*) ------------------------- #
+        #                          (*  *)   (* ﰤ *)
+        rewards[alive & (tr == 1) & (st_tr == 2)] = 0.5
+        # ------------------------ (0,*,*) → (1,*,*) ------------------------- #
+        #                          ( * *)   (理* *)
+        rewards[alive & (sw == 0) & (st_sw == 1)] = 0.5
+        # -------------------- (*,2,start) → (*,2,start) --------------------- #
+        #                      (* 2 ◉ )      (* 2 ◉ )
+        rewards[alive & (tr == 2) & (st_tr == 2) & (p == n * m - 1) & (st_p == n * m - 1)] = 1
+        R[states] = rewards
         return R
 
     # ────────────────── constructing the transition matrix ────────────────── #
     def make_transition_matrix(self):
         """
-        Creates the complete transition matrix, including every possible state
+        Creates the complete transition model, including every possible state
         and action, and the transition from one to another.
 
         Contains all the possible values of T(s, a, s'), the probability to go
         from s to s' by doing a.
+
+        Every transition is done in two steps:
+            - moving on the grid: the position reached by the move or, when
+              the move leads to a portal or a moving platform, the distribution
+              over the positions where the player is teleported. Items are not
+              impacted by this step.
+            - entering the cell: a single step of the stable markov chain
+              (fighting, picking up items, falling in a trap ...)
+        The grid moves are the same for the 6 combinations of items, the model
+        is kept factored (see FactoredTransition): T.expand() builds the flat
+        N x N matrices when they are needed.
         """
-        n_states = State.max_id + 1 # last state is death
         n, m = self.n, self.m
-        T = np.zeros((n_states, 4, n_states), np.float64)
         S = self.markov_chain()
         M = self.moving_markov_chain()
-        # ────────────────────────── for each state ────────────────────────── #
-        for sw in range(2):
-            for tr in range(3):
-                for p in range(n * m):
-                    i, j = p // m, p % m
-                    s = State(sw, tr, p)
-                    cell = self.map[i, j]
-                    # ───────── find the transitions from that state ───────── #
-                    if cell == Cell.magic_portal or cell == Cell.moving_platform:
-                        transitions = self.special_transition(S, M, s)
-                    else:
-                        transitions = S[s.id, :]
-                    # ─────── find the state - actions that lead to it ─────── #
-                    for ((k, l), direction) in self.map.neighbors(i, j):
-                        # if (k,l) is ↑ of (i, j), (i, j) is ↓ of (k, l)
-                        s.position = k * m + l
-                        reverse_dir = direction.reverse
-                        T[s.id, reverse_dir.to_int, :] = transitions
-        # ─────────── any action not yet found is to stay inplace ──────────── #
-        for sid in range(n_states):
-            for a in Direction:
-                s = State(s_id=sid)
-                if sum(T[s.id, a.to_int]) == 0:
-                    mu = np.zeros(n_states, np.float64)
-                    mu[s.id] = 1
-                    T[s.id, a.to_int, :] = S.iterate(mu)
-        return T
+        self.teleport_distributions = self.make_teleport_distributions(M)
+        G = [self.grid_moves(a, np.arange(n * m)) for a in Direction]
+        # death ends the game, no transition leaves it (its row is empty)
+        grid = np.array(list(self.map)).reshape(n, m)
+        return FactoredTransition(G, S, grid, self.teleport_distributions)
 
-    # ──────────────── handling moving platforms and portals ───────────────── #
-    def special_transition(self, S: MarkovChain, M: MarkovChain, state: State):
+    def update_transition_matrix(self, T: FactoredTransition):
+        """
+        Patches a transition model built for a previous layout of the map.
+
+        Only the grid moves leading to the cells that changed since T was built
+        are recomputed, as well as the ones leading to portals and platforms
+        whose distribution depends on those cells. The stable markov chain is
+        rebuilt (it is linear in the number of states).
+
+        @return T, states:
+                    - T: the patched model (the same object), or a new model
+                      if the shape of the map changed
+                    - states: array of the states whose transitions changed,
+                      None if the whole model was rebuilt
+        """
+        n, m = self.n, self.m
+        grid = np.array(list(self.map)).reshape(n, m)
+        if not isinstance(T, FactoredTransition) or T.grid is None or \
+                T.grid.shape != (n, m): # same cells, another shape: other moves
+            return self.make_transition_matrix(), None
+        changed = np.flatnonzero(grid != T.grid)
+        # ──────────── the teleportations depend on walls as well ──────────── #
+        structure = (Cell.wall, Cell.magic_portal, Cell.moving_platform)
+        old = T.teleport_distributions
+        if any(T.grid.flat[c] in structure or grid.flat[c] in structure for c in changed):
+            new = self.make_teleport_distributions(self.moving_markov_chain())
+        else:
+            new = old
+        self.teleport_distributions = new
+        # ───────────────── cells whose entering has changed ───────────────── #
+        targets = set(changed)
+        for q in set(old) | set(new):
+            if q not in old or q not in new or not np.array_equal(old[q], new[q]) \
+                    or new[q][changed].any():
+                targets.add(q)
+        # ────────────── positions moving to one of those cells ────────────── #
+        moves = self.map.next_positions()
+        sources = np.flatnonzero(np.isin(moves, list(targets)).any(axis=0))
+        blocks = State.swords * State.treasures
+        states = np.add.outer(np.arange(blocks) * n * m, sources).ravel()
+        # ─────────────────────── recompute those rows ─────────────────────── #
+        T.patch(sources, [self.grid_moves(a, sources) for a in Direction], self.markov_chain())
+        T.grid, T.teleport_distributions = grid, new
+        return T, states
+
+    def grid_moves(self, a: Direction, positions: np.array):
         """
-        @param S: Markovchain= a markov chain representing the stable states of
-                  the dungeon, i.e. the states that must only be iterated once
-                  ex: the 'over an ennemy cell' state. that state might lead to
-                  itself, and yet you won't fight the ennemy again.
-                  this markov chain must only be used to advance of 1 time step.
+        @param a: Direction= the action played
+        @param positions: array of k starting positions on the grid
 
-                  it contains every actual states of the game, including the
-                  'death' state.
+        @return sparse k x (n * m) matrix: for each starting position, the
+                distribution over the cells entered by moving in direction a.
+                Uses the teleport distributions already computed.
+        """
+        n, m = self.n, self.m
+        targets = self.map.next_positions()[a.to_int, positions]
+        rows, cols, probs = [], [], []
+        for (h, (p, q)) in enumerate(zip(positions.tolist(), targets.tolist())):
+            # ───────── moving into a portal or a platform teleports ───────── #
+            if q != p and self.map[q] in (Cell.magic_portal, Cell.moving_platform):
+                distrib = self.teleport_distributions[q]
+                cells = np.flatnonzero(distrib)
+                rows += [h] * len(cells)
+                cols += list(cells)
+                probs += list(distrib[cells])
+            # ──── else enter the cell (the same one if against a border) ──── #
+            else:
+                rows.append(h)
+                cols.append(q)
+                probs.append(1)
+        return sparse.csr_matrix((probs, (rows, cols)), shape=(len(positions), n * m))
 
+    # ──────────────── handling moving platforms and portals ───────────────── #
+    def make_teleport_distributions(self, M: MarkovChain):
+        """
         @param M: Markochain= a markov chain representing the 'moving states' of
                   the dungeon, i.e. the states that can be recursive. those
                   states, such as the moving platform and the portal, are just
                   temporary. they lead you to another stable state, or to
                   another moving state that will lead you back elsewhere. they
                   can be infinitely cycling between themselves.
-                  To deal with such states, we need to iterate a markov chain
-                  until we reach stable probabilities, i.e. probabilities over
-                  the states that are unchanged upon iteration of the markov
-                  chain.
 
                   To simplify this, as the two cells considered here only impact
                   the position on the grid, we use a reduced version of the
                   states, only including n * m states (the grid positions).
 
-                  The result obtained at stability is the probability to be in
-                  each cell of the dungeon, after using a moving platform or
-                  teleporter. It accounts for every recursive teleportation
-                  that can occur.
+        @return dict(position -> array of n * m probabilities), for every
+                'moving cell', the distribution over the grid positions after
+                the teleportation. The cell reached must then be entered (one
+                step of the stable markov chain).
 
-        @param state: State= the particular state to be computed. It must be
-                  a state where the position corresponds to a 'moving cell'.
-
-        This function deals with two difficult or 'special' states, the portal
+        This function deals with two difficult or 'special' cells, the portal
         and the moving platform. They teleport the player to another cell, that
-        is then triggered as if the player just walked into it. If that state is
+        is then triggered as if the player just walked into it. If that cell is
         a portal or moving platform, the result is recursive and might lead again
         to a teleportation, effectively creating possible infinite loop.
 
-        To deal with such states, we use two markov chains. One considering stable
-        states, that must be iterated only once, and one for the recursive states
-        that is iterated until we find a correct probability distribution.
+        The moving cells are the transient states of M, and every other cell
+        is absorbing: the distribution after every recursive teleportation is
+        the absorption probability of the chain, computed for every moving
+        cell at once with a single linear solve.
+        """
+        moving = np.array([c in (Cell.magic_portal, Cell.moving_platform) for c in self.map])
+        B = M.absorption(moving)
+        return {p: B[p] for p in np.flatnonzero(moving)}
 
-        Ad this methods operates with heavy matrix operations that might be
-        needed multiple times, we store the results of already computed calculations
-        to reuse them and modify them according to the need.
+    def make_sparse_teleports(self):
+        """
+        Sparse version of make_teleport_distributions, for maps too large for
+        the dense moving markov chain (n * m x n * m).
+
+        Every portal leads to the same distribution B_portal. The distribution
+        of a platform is the absorption of its random walk among the platforms
+        (L, sparse as the walk stays local), plus the probability to fall into
+        a portal on the way (c) times B_portal. B_portal itself is the uniform
+        distribution over the free cells, the moving ones being replaced by
+        their own distribution, which gives a scalar equation.
+
+        @return moving, L, c, B_portal:
+                    - moving: array of the k moving cells (portals and platforms)
+                    - L: sparse k x (n * m) matrix
+                    - c: array of k probabilities
+                    - B_portal: array of n * m probabilities
+                such that the distribution of the moving cell moving[i] is
+                L[i] + c[i] * B_portal (see make_teleport_distributions)
         """
-        # This method will be heavily commented
         n, m = self.n, self.m
-
-        # ──────────── extracting the grid position of the state ───────────── #
-        p = state.position
-
-        # ────────────── checking that the state given is valid ────────────── #
-        assert self.map[p] in (Cell.magic_portal, Cell.moving_platform)
-
-        # ────────────────── checking for existing results ─────────────────── #
-        distrib = np.zeros(n * m, np.float64)
-        if p in self.teleport_distributions:
-            distrib = self.teleport_distributions[p]
-        # ─────────────── compute the results if not available ─────────────── #
+        grid = np.array(list(self.map))
+        free = grid != Cell.wall
+        portal = grid == Cell.magic_portal
+        platform = grid == Cell.moving_platform
+        # ───────────── platforms : adjacent cells but the walls ───────────── #
+        cells = np.arange(n * m)
+        rows, cols = [], []
+        for q in self.map.next_positions():
+            inside = platform & (q != cells) & free[q]
+            rows.append(cells[inside])
+            cols.append(q[inside])
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        degree = np.bincount(rows, minlength=n * m)
+        A = sparse.csr_matrix((1 / degree[rows], (rows, cols)), shape=(n * m, n * m))
+        # ── closed groups of platforms (or surrounded by walls) are absorbing ── #
+        escapes = ~platform
+        while True:
+            reach = escapes | (platform & (A.dot(escapes.astype(np.float64)) > 0))
+            if (reach == escapes).all(): break
+            escapes = reach
+        walking = np.flatnonzero(platform & escapes)
+        stable = ~(portal | (platform & escapes))
+        # ──────── absorption of the walks, L and c of the platforms ───────── #
+        A = A[walking]
+        Q = A[:, walking]
+        R = sparse.hstack([A.dot(sparse.diags(stable.astype(np.float64))),
+                           sparse.csr_matrix(A.dot(portal.astype(np.float64))[:, None])])
+        if len(walking):
+            X = sparse.csr_matrix(spsolve((sparse.identity(len(walking)) - Q).tocsc(),
+                                          R.tocsc()).reshape(len(walking), -1))
         else:
-            # Create a probability vector where we are in p
-            mu = np.zeros(n * m, np.float64)
-            mu[p] = 1
-            distrib = M.convergence_iteration(mu)
-            self.teleport_distributions[p] = distrib
-        assert distrib.shape == (n * m,) and abs(sum(distrib) - 1) < 10e-6
-
-        # ───────────────── convert grid positions to state ────────────────── #
-        # We now have the distribution over the grid position. However, we need
-        # a distribution over the real state of the game, accounting for items.
-        # As the special cells do not impact (yet) items, we just need to 
-        # put this vector at the right place in the (6 times) larger state vector
-        # of the dungeon.
-        padding = state.sword * 3 + state.treasure
-        block_size = n * m
-
-        transition = np.zeros(State.max_id + 1, np.float64)
-        transition[padding * block_size: (padding + 1) * block_size] = distrib
-
-        # ───── iterate once the new states over the rest of the dungeon ───── #
-        transition = S.iterate(transition, 1)
-        assert abs(sum(transition) - 1) < 10e-5
-        return transition
+            X = sparse.csr_matrix((0, n * m + 1))
+        L_walk, c_walk = X[:, :n * m], X[:, n * m].toarray().ravel()
+        # ─────────────────── the distribution of portals ──────────────────── #
+        B_portal = (free & stable) + np.asarray(L_walk.sum(axis=0)).ravel()
+        B_portal /= np.sum(free) - np.sum(portal) - c_walk.sum()
+        # ─────────────────── every moving cell, in order ──────────────────── #
+        portals = np.flatnonzero(portal)
+        moving = np.concatenate([walking, portals])
+        L = sparse.vstack([L_walk, sparse.csr_matrix((len(portals), n * m))]).tocsr()
+        c = np.concatenate([c_walk, np.ones(len(portals))])
+        return moving, L, c, B_portal
+
+    # ──────────────── outcomes of entering each type of cell ──────────────── #
+    def cell_outcomes(self):
+        """
+        Lookup table of the semantics of the cells, as played in Dungeon.enter
+
+        @return dict(Cell -> list of (p, p_sword, effect)), the possible
+                outcomes of entering a cell:
+                    - p, p_sword: probability of the outcome without / with
+                      the magic sword
+                    - effect: the consequence on the state, one of
+                        'stay':     nothing happens
+                        'start':    back to the starting position
+                        'death':    the adventurer dies
+                        'sword':    the magic sword is picked up
+                        'key':      the golden key is picked up
+                        'treasure': the treasure is picked up (with the key)
+
+        Portals and moving platforms only move the adventurer, they are handled
+        by the moving markov chain.
+        """
+        p = self.p_enemy
+        return {
+            Cell.empty:           [(1, 1, 'stay')],
+            Cell.start:           [(1, 1, 'stay')],
+            Cell.wall:            [(1, 1, 'start')], # bounce back to start
+            Cell.crack:           [(1, 1, 'death')], # kill instantly
+            Cell.enemy_normal:    [(p, 1, 'stay'), (1 - p, 0, 'death')],
+            Cell.enemy_special:   [(1, 1 - p, 'stay'), (0, p, 'death')],
+            Cell.magic_sword:     [(1, 1, 'sword')],
+            Cell.golden_key:      [(1, 1, 'key')],
+            Cell.treasure:        [(1, 1, 'treasure')],
+            Cell.trap:            [(0.6, 0.6, 'stay'), (0.3, 0.3, 'start'),
+                                   (0.1, 0.1, 'death')],
+            Cell.magic_portal:    [(1, 1, 'stay')],
+            Cell.moving_platform: [(1, 1, 'stay')],
+        }
 
     # ──────────────────── constructing the markov chain ───────────────────── #
     def markov_chain(self):
-        n_state = State.max_id + 1 # because max id is n - 1
-        M = np.zeros((n_state, n_state), np.float64)
+        """
+        Creates the stable markov chain over every state of the game: the
+        result of entering the cell of the state, to be iterated only once.
+
+        The chain is built from the lookup table of Dungeon.cell_outcomes,
+        every state standing on the same type of cell at once.
+
+        @return sparse N x N matrix (a handful of non-zero values per row)
+        """
+        n_state = self.space.n_states
         n, m = self.n, self.m
         death = n_state - 1
-        M[death, death] = 1
-        for sw in range(2):
-            for tr in range(3):
-                for p in range(n * m):
-                    i, j = p // m, p % m
-                    cell = self.map[i, j]
-                    state = State(sw, tr, p)
-                    index = state.id
-                    # ────────────── empty cell : stay inplace ─────────────── #
-                    if cell == Cell.empty or cell == Cell.start:
-                        M[index, index] = 1
-                    # ───────────── wall : bounce back to start ────────────── #
-                    if cell == Cell.wall:
-                        state.position = n * m - 1
-                        M[index, state.id] = 1
-                    # ──────────────── crack : kill instantly ──────────────── #
-                    if cell == Cell.crack:
-                        M[index, death] = 1
-                    # ──────────────────── ennemy : fight ──────────────────── #
-                    if cell == Cell.enemy_normal and state.sword:
-                        M[index, index] = 1 # fight won
-                    if cell == Cell.enemy_normal and not state.sword:
-                        M[index, index] = Dungeon.p_enemy
-                        M[index, death] = 1 - Dungeon.p_enemy
-                    # ───────── political enemy : do not use a sword ───────── #
-                    if cell == Cell.enemy_special and not state.sword:
-                        M[index, index] = 1 # not dangerous when weaponless
-                    if cell == Cell.enemy_special and state.sword:
-                        M[index, index] = Dungeon.p_enemy
-                        M[index, death] = 1 - Dungeon.p_enemy
-                    # ─────────────── magic sword acquisition ──────────────── #
-                    if cell == Cell.magic_sword:
-                        state.sword = 1
-                        M[index, state.id] = 1
-                    # ─────────────────── key acquisition ──────────────────── #
-                    if cell == Cell.golden_key:
-                        state.treasure = max(state.treasure, 1)
-                        # get the key if you didn't have it, else keep the treasure
-                        M[index, state.id] = 1
-                    # ───────────────── treasure acquisition ───────────────── #
-                    if cell == Cell.treasure:
-                        state.treasure = 2 if state.treasure >= 1 else 0
-                        M[index, state.id] = 1
-                    # ─────── trap : back to start, death, or nothing ──────── #
-                    if cell == Cell.trap:
-                        M[index, index] = 0.6 # nothing happens
-                        state.position = n * m - 1
-                        M[index, state.id] = 0.3 # tunnel to start
-                        M[index, death] = 0.1 # death
-                    if cell == Cell.magic_portal or cell == Cell.moving_platform:
-                        M[index, index] = 1
-        return MarkovChain(M)
+        # ────────────── decompose every (living) state at once ────────────── #
+        ids = np.arange(n_state - 1)
+        sw, tr, p = self.space.decode(ids)
+        grid = np.array(list(self.map))
+        cells = grid[p]
+        # ──────────────── the state reached for every effect ──────────────── #
+        effects = {
+            'stay':     ids,
+            'start':    self.space.encode(sw, tr, n * m - 1),
+            'death':    np.full(n_state - 1, death),
+            'sword':    self.space.encode(1, tr, p),
+            'key':      self.space.encode(sw, np.maximum(tr, 1), p),
+            # the treasure can only be picked up with the key
+            'treasure': self.space.encode(sw, np.where(tr >= 1, 2, 0), p),
+        }
+        # ──────────────── apply the table to the whole grid ───────────────── #
+        rows, cols, probs = [np.array([death])], [np.array([death])], [np.ones(1)]
+        for (cell, outcomes) in self.cell_outcomes().items():
+            on_cell = np.flatnonzero(cells == cell)
+            for (p_nosword, p_sword, effect) in outcomes:
+                prob = np.where(sw[on_cell], p_sword, p_nosword)
+                rows.append(on_cell[prob > 0])
+                cols.append(effects[effect][on_cell[prob > 0]])
+                probs.append(prob[prob > 0])
+        rows, cols, probs = [np.concatenate(x) for x in (rows, cols, probs)]
+        return sparse.csr_matrix((probs, (rows, cols)), shape=(n_state, n_state))
 
     def moving_markov_chain(self):
         """
         Creates a markov chain with grid cells as states, to determine the
         probability to be in a state when using a recurrent transition (portal,
         moving-platform)
+            - a moving platform moves to any adjacent cell that is not a wall
+            - a portal teleports to any cell of the dungeon that is not a wall
+            - every other cell is absorbing
         """
         n, m = self.n, self.m
         n_state = n * m
+        grid = np.array(list(self.map))
+        free = grid != Cell.wall
         M = np.zeros((n_state, n_state), np.float64)
-        for p in range(n * m):
-            i, j = p // m, p % m
-            cell = self.map[i, j]
-            if cell == Cell.moving_platform:
-                valid_neighbors = self.map.all_cell_dist((i, j), 1)
-                for (k, l) in valid_neighbors:
-                    p_next = k * m + l
-                    M[p, p_next] = 1 / len(valid_neighbors)
-            elif cell == Cell.magic_portal:
-                valid_cells = self.map.all_cell_dist((i, j), -1)
-                for (k, l) in valid_cells:
-                    p_next = k * m + l
-                    M[p, p_next] = 1 / len(valid_cells)
-            else:
-                M[p, p] = 1
+        # ─────────────────────── stable cells : stay ──────────────────────── #
+        stable = np.flatnonzero((grid != Cell.moving_platform) & (grid != Cell.magic_portal))
+        M[stable, stable] = 1
+        # ──────────────── portals : every cell but the walls ──────────────── #
+        portals = np.flatnonzero(grid == Cell.magic_portal)
+        M[np.ix_(portals, np.flatnonzero(free))] = 1 / np.sum(free)
+        # ───────────── platforms : adjacent cells but the walls ───────────── #
+        platforms = np.flatnonzero(grid == Cell.moving_platform)
+        i, j = platforms // m, platforms % m
+        for direction in Direction:
+            di, dj = direction.value
+            ni, nj = i + di, j + dj
+            inside = (0 <= ni) & (ni < n) & (0 <= nj) & (nj < m)
+            q = ni[inside] * m + nj[inside]
+            valid = free[q]
+            M[platforms[inside][valid], q[valid]] = 1
+        # a platform surrounded by walls can't move: the adventurer stays on it
+        stuck = platforms[M[platforms].sum(axis=1) == 0]
+        M[stuck, stuck] = 1
+        M[platforms] /= M[platforms].sum(axis=1)[:, None]
         return MarkovChain(M)
 
     # ────────────────────── is that dungeon winnable ? ────────────────────── #
@@ -331,118 +496,242 @@ class Dungeon(object):
 
         @return an int, the reward associated with this action in that state
         """
-        self.last_actions[self.agents.index(agent)] = direction
-        agent.pos = self.map.move(agent.pos, direction)
-        return self.enter(agent, self.map[agent.pos])
+        self.last_actions[self.slots[agent]] = direction
+        moves = self.step_tables()[0]
+        return self.arrive(agent, moves[direction.to_int][agent.cell_id])
 
     def teleport(self, agent: Adventurer, position: (int, int)):
         """ Teleports an agent to a given position (might be usefull for animations)"""
         i, j = position
         assert 0 <= i < self.n and 0 <= j < self.m, "can't teleport outside of the dungeon"
         assert self.map[position] != Cell.wall, "can't teleport in a wall"
-        agent.pos = position
-        self.caption += '\n'
-        return self.enter(agent, self.map[agent.pos])
+        self.emit(Event.teleported)
+        return self.arrive(agent, i * self.m + j)
 
-    # ─────────────────────────── entering a cell ──────────────────────────── #
-    def enter(self, agent: Adventurer, cell: Cell):
+    def enter(self, agent: Adventurer):
         """
-        Performs the most simple cells tasks, and delegates to appropriate
-        functions if needed
+        Enters the cell of the agent's position, see step
 
         @return an int representing the reward of the move
         """
-        # assert cell != Cell.wall, "wall cells should never be entered"
-        sword = agent.has_item(Cell.magic_sword)
-        # -------------- walls bounce back to starting position -------------- #
-        if cell == Cell.wall:
-            self.caption += "Bounced against a wall ... Back to start !"
-            return self.teleport(agent, (self.n - 1, self.m - 1))
-        # ---------------- items are treated in the same way ----------------- #
-        elif cell == Cell.golden_key or cell == Cell.magic_sword:
-            if agent.has_item(cell):
-                self.caption += "Can't pick up another {}, already have one".format(cell.name)
-            else:
-                self.caption += "Picked up an item ({}) !!".format(cell.name)
-                agent.acquire_item(cell)
-                return 0.5
-        # ------------------ treasure is particular, though ------------------ #
-        elif cell == Cell.treasure and agent.has_item(Cell.golden_key):
-            if agent.has_item(cell):
-                self.caption += "Can't pick up another {}, already have one".format(cell.name)
-            else:
-                self.caption += "Got the treasure !"
-                agent.acquire_item(cell)
-                return 0.5
-        # ------------ magic portal and moving platforms teleport ------------ #
-        elif cell == Cell.magic_portal:
-            valid_cell = self.map.random_cell_dist()
-            self.caption += "STARGAAAATE : {} → {}".format(agent.pos, valid_cell)
-            return self.teleport(agent, valid_cell)
-        elif cell == Cell.moving_platform:
-            valid_neighbor = self.map.random_cell_dist(agent.pos, 1)
-            (nx, ny), (x, y) = valid_neighbor, agent.pos
-            self.caption += "Woops ! It moves ! (teleported to {})".format(Direction((nx - x, ny - y)).name)
-            return self.teleport(agent, valid_neighbor) # adjacent cell <=> Manhattan dist of 1
-        # ---------------------- oh, CRACK, you're dead ---------------------- #
-        elif cell == Cell.crack:
-            self.caption += "DAMN ! CRACK !!! I'm dead."
+        return self.arrive(agent, agent.cell_id)
+
+    def arrive(self, agent: Adventurer, position: int):
+        """ Resolves the arrival of an agent on a cell id, and updates it """
+        position, block, reward, status = self.resolve(position, agent.block)
+        agent.pos, agent.block = divmod(position, self.m), block
+        if status == Dungeon.dead:
             self.kill(agent)
-        # ----------------------- care, it's a trap !! ----------------------- #
-        elif cell == Cell.trap:
-            p = random() # random floating number in [0, 1[
-            self.caption += "ITS A TRAPPP "
-            if p < 0.1:
-                self.caption += "I'm dead."
-                self.kill(agent) # 10% : death
-            elif p < 0.4:
-                self.caption += "Back to start. (tunneled :] )"
-                return self.teleport(agent, (self.n - 1, self.m - 1)) # 30% : back to start
-            else:
-                self.caption += "But it's ineffective."
-            # 60% : nothing
-        # ----------------------------- FIGHT !! ----------------------------- #
-        # -------------------- normal enemy (use a sword) -------------------- #
-        elif cell == Cell.enemy_normal and not sword:
-            # no fight for the brave wielding a sword
-            self.caption += "Enemy in sight ! "
-            p = random() # random floating number in [0, 1[
-            if p < Dungeon.p_enemy: # the player is victorious (p_enemy)%
-                self.caption += "Easily defeated."
-            else:
-                self.caption += "Woops, I'm dead"
-                self.kill(agent)
-        elif cell == Cell.enemy_normal and sword:
-            self.caption += "BIM ! BAM ! MAGIC SWORD IN YOUR FACE !"
-        # -------------------------- special enemy --------------------------- #
-        elif cell == Cell.enemy_special and not sword:
-            # don't fight
-            self.caption += "Not a threat for me."
-        elif cell == Cell.enemy_special and sword:
-            self.caption += "This enemy can't be slain ! "
-            p = random()  # random floating number in [0, 1[
-            if p > Dungeon.p_enemy:  # the player is victorious (p_enemy)%
-                self.caption += "I managed to flee."
-            else:
-                self.caption += "Goodbye, sweet world"
-                self.kill(agent)
-        # ------------ returning to the start (with the treasure) ------------ #
-        elif cell == Cell.start and agent.has_item(Cell.treasure):
-            self.caption += "I WON. !!!"
+        elif status == Dungeon.won:
             self.victory(agent)
-            return 1
+        return reward
+
+    # ─────────────────── events, for the interfaces only ──────────────────── #
+    def emit(self, code: Event, *args):
+        """ Records an event (see events.Event), nothing when headless """
+        if self.events is not None:
+            self.events.push(code, *args)
+
+    def clear_events(self):
+        if self.events is not None:
+            self.events.clear()
+
+    # ───────────────────── single step, on integer ids ────────────────────── #
+    playing, dead, won, teleported = range(4) # status of a step
 
-        # ───────────── handle the reward in various situations ────────────── #
-        return -1 if not agent.alive else 0
+    def step(self, state_id: int, action: int):
+        """
+        Plays an action from a state, without any Adventurer: the low-level
+        kernel of the game (see Dungeon.move, its object version)
+
+        @param state_id: int= complete id of the state (see State)
+        @param action: int= the action played (see Direction.to_int)
+        @return next_id, reward, done: the state reached (space.max_id when
+                dead), the reward, and whether the game is over
+        """
+        n_cells = self.n * self.m
+        block, position = divmod(state_id, n_cells)
+        if block >= State.swords * State.treasures:
+            return state_id, 0, True # death
+        moves = self.step_tables()[0]
+        position, block, reward, status = self.resolve(moves[action][position], block)
+        if status == Dungeon.dead:
+            return self.space.max_id, reward, True
+        return block * n_cells + position, reward, status == Dungeon.won
+
+    def resolve(self, position: int, block: int):
+        """
+        Enters a cell, then the cells reached by teleportation
+
+        @param position: int= cell id entered
+        @param block: int= items held, sword * treasures + treasure
+        @return position, block, reward, status: the cell and items at the end
+                of the step, its reward and status (playing, dead or won)
+        """
+        effects = self.step_tables()[1]
+        position, block, reward, status = effects[position](position, block)
+        while status == Dungeon.teleported:
+            self.emit(Event.teleported)
+            position, block, reward, status = effects[position](position, block)
+        return position, block, reward, status
+
+    def step_tables(self):
+        """
+        Lookup tables of the current layout, rebuilt when the map changes
+
+        @return moves, effects, free, neighbors: lists indexed by cell id
+                    - moves[a][p]: cell reached from p by the action a
+                    - effects[p]: the method entering p (see resolve)
+                    - free: every cell but the walls (portal destinations)
+                    - neighbors[p]: destinations of a moving platform p, empty
+                      when it can't lead anywhere else (it keeps the adventurer)
+        """
+        key = (id(self.map), self.map.version)
+        if self._step_key == key:
+            return self._step_tables
+        n, m = self.n, self.m
+        grid = list(self.map)
+        moves = self.map.next_positions()
+        free = [p for p in range(n * m) if grid[p] != Cell.wall]
+        # ──────── platforms : adjacent cells but the walls, if open ───────── #
+        neighbors = [[q for q in moves[:, p].tolist() if q != p and grid[q] != Cell.wall]
+                     if grid[p] == Cell.moving_platform else [] for p in range(n * m)]
+        platform = [p for p in range(n * m) if grid[p] == Cell.moving_platform]
+        escapes = {p for p in range(n * m) if grid[p] != Cell.moving_platform}
+        while True:
+            reach = {p for p in platform if any(q in escapes for q in neighbors[p])}
+            if reach <= escapes: break
+            escapes |= reach
+        for p in platform:
+            if p not in escapes:
+                neighbors[p] = []
+        handlers = {
+            Cell.empty:           self.enter_empty,
+            Cell.start:           self.enter_start,
+            Cell.wall:            self.enter_wall,
+            Cell.magic_sword:     self.enter_sword,
+            Cell.golden_key:      self.enter_key,
+            Cell.treasure:        self.enter_treasure,
+            Cell.magic_portal:    self.enter_portal,
+            Cell.moving_platform: self.enter_platform,
+            Cell.crack:           self.enter_crack,
+            Cell.trap:            self.enter_trap,
+            Cell.enemy_normal:    self.enter_enemy_normal,
+            Cell.enemy_special:   self.enter_enemy_special,
+        }
+        effects = [handlers[cell] for cell in grid]
+        self._step_key = key
+        self._step_tables = moves.tolist(), effects, free, neighbors
+        return self._step_tables
+
+    # ────────────────────── entering each type of cell ────────────────────── #
+    # (position, block) → (position, block, reward, status), see resolve
+    def enter_empty(self, p: int, block: int):
+        return p, block, 0, Dungeon.playing
+
+    # -------------- returning to the start (with the treasure) -------------- #
+    def enter_start(self, p: int, block: int):
+        if block % State.treasures == 2:
+            self.emit(Event.victory)
+            return p, block, 1, Dungeon.won
+        return p, block, 0, Dungeon.playing
+
+    # ---------------- walls bounce back to starting position ---------------- #
+    def enter_wall(self, p: int, block: int):
+        self.emit(Event.wall)
+        return self.n * self.m - 1, block, 0, Dungeon.teleported
+
+    # ------------------ items are treated in the same way ------------------- #
+    def enter_sword(self, p: int, block: int):
+        if block >= State.treasures:
+            self.emit(Event.item_held, 1)
+            return p, block, 0, Dungeon.playing
+        self.emit(Event.item_picked, 1)
+        return p, block + State.treasures, 0.5, Dungeon.playing
+
+    def enter_key(self, p: int, block: int):
+        if block % State.treasures:
+            self.emit(Event.item_held, 0)
+            return p, block, 0, Dungeon.playing
+        self.emit(Event.item_picked, 0)
+        return p, block + 1, 0.5, Dungeon.playing
+
+    # -------------------- treasure is particular, though -------------------- #
+    def enter_treasure(self, p: int, block: int):
+        treasure = block % State.treasures
+        if treasure == 2:
+            self.emit(Event.item_held, 2)
+        elif treasure == 1:
+            self.emit(Event.treasure)
+            return p, block + 1, 0.5, Dungeon.playing
+        return p, block, 0, Dungeon.playing
+
+    # -------------- magic portal and moving platforms teleport -------------- #
+    def enter_portal(self, p: int, block: int):
+        free = self._step_tables[2]
+        q = free[int(self.random() * len(free))]
+        if self.events is not None:
+            self.emit(Event.portal, *divmod(p, self.m), *divmod(q, self.m))
+        return q, block, 0, Dungeon.teleported
+
+    def enter_platform(self, p: int, block: int):
+        neighbors = self._step_tables[3][p]
+        if not neighbors: # closed platforms keep the adventurer
+            return p, block, 0, Dungeon.playing
+        q = neighbors[int(self.random() * len(neighbors))]
+        if self.events is not None:
+            (i, j), (ni, nj) = divmod(p, self.m), divmod(q, self.m)
+            self.emit(Event.platform, ni - i, nj - j)
+        return q, block, 0, Dungeon.teleported
+
+    # ------------------------ oh, CRACK, you're dead ------------------------ #
+    def enter_crack(self, p: int, block: int):
+        self.emit(Event.crack)
+        return p, block, -1, Dungeon.dead
+
+    # ------------------------- care, it's a trap !! ------------------------- #
+    def enter_trap(self, p: int, block: int):
+        u = self.random() # random floating number in [0, 1[
+        if u < 0.1: # 10% : death
+            self.emit(Event.trap_death)
+            return p, block, -1, Dungeon.dead
+        if u < 0.4: # 30% : back to start
+            self.emit(Event.trap_start)
+            return self.n * self.m - 1, block, 0, Dungeon.teleported
+        self.emit(Event.trap_missed) # 60% : nothing
+        return p, block, 0, Dungeon.playing
+
+    # ------------------------------- FIGHT !! ------------------------------- #
+    def enter_enemy_normal(self, p: int, block: int):
+        if block >= State.treasures: # no fight for the brave wielding a sword
+            self.emit(Event.sword)
+        elif self.random() < self.p_enemy: # the player is victorious (p_enemy)%
+            self.emit(Event.enemy_won)
+        else:
+            self.emit(Event.enemy_death)
+            return p, block, -1, Dungeon.dead
+        return p, block, 0, Dungeon.playing
+
+    def enter_enemy_special(self, p: int, block: int):
+        if block < State.treasures: # don't fight
+            self.emit(Event.no_threat)
+        elif self.random() > self.p_enemy:
+            self.emit(Event.special_fled)
+        else:
+            self.emit(Event.special_death)
+            return p, block, -1, Dungeon.dead
+        return p, block, 0, Dungeon.playing
 
-    # ────────────────────────────────── Reset ─────────────────────────────── #
+    # ──────────────────────────────── Reset ───────────────────────────────── #
     def reset(self):
         """ Hard reset : resets the map, and every agent """
         self.map.reset()
         self.m, self.n = self.map.m, self.map.n
         self.last_actions = [None for x in self.agents]
-        State.configure(self.n, self.m)
-        self.caption = ''
+        if (self.space.n, self.space.m) != (self.n, self.m): # a map of another size
+            self.space = StateSpace(self.n, self.m)
+        State.configure(self.space)
+        self.clear_events()
         self.over, self.won = False, False
         for agent in self.agents:
             agent.n, agent.m = self.n, self.m
@@ -452,7 +741,7 @@ class Dungeon(object):
         """ Soft reset to replay the same map """
         self.map.reset()
         self.last_actions = [None for x in self.agents]
-        self.caption = ''
+        self.clear_events()
         self.over, self.won = False, False
         for agent in self.agents:
             agent.soft_reset()
@@ -30,3 +30,33 @@ class MarkovChain(np.ndarray):
             mu = mu_next
             mu_next = self.iterate(mu)
         return mu_next
+
+    def absorption(self, transient: np.array):
+        """
+        transient: boolean mask of the transient states of the chain, every
+                   other state being absorbing
+
+        returns the N x N matrix of the probabilities, starting from each state,
+        to end up in each absorbing state (identity rows for absorbing states)
+
+        Every distribution is obtained at once from the fundamental matrix of
+        the chain, B = (I - Q)^-1 R, where Q holds the transitions between
+        transient states and R the transitions from transient to absorbing
+        states. Transient states that can never reach an absorbing state (a
+        closed cycle) are considered absorbing themselves.
+        """
+        P = np.asarray(self)
+        # ───── transient states must be able to reach an absorbing one ────── #
+        escapes = ~transient
+        while True:
+            reach = escapes | (transient & (P[:, escapes].sum(1) > 0))
+            if (reach == escapes).all(): break
+            escapes = reach
+        transient = transient & escapes
+        # ───────────────── solve the absorbing markov chain ───────────────── #
+        Q = P[np.ix_(transient, transient)]
+        R = P[np.ix_(transient, ~transient)]
+        B = np.identity(self.chain_size)
+        B[transient] = 0
+        B[np.ix_(transient, ~transient)] = np.linalg.solve(np.identity(len(Q)) - Q, R)
+        return B
@@ -2,29 +2,77 @@
 # enconding: utf-8
 # ───────────────────────────────── imports ────────────────────────────────── #
 from .characters import State, Adventurer
+from .states import StateIndex
 from .kernel import Dungeon
 from .dungeon_map import Direction, Cell
 from .utils import rand_argmax
+from scipy import sparse
+from scipy.sparse.linalg import spsolve, bicgstab, LinearOperator
 import numpy as np
 # ──────────────────────────────────────────────────────────────────────────── #
 
 class MDP(Adventurer):
+
+    compact = True # solve over the reachable states only (see StateIndex)
+    matrix_free = False # never store the transitions (see MapOperator)
+    solver = 'jacobi' # value iteration: 'jacobi', 'gauss-seidel', 'async', 'prioritized'
+                      # or 'phases'
+    priority_batch = 1 / 4 # fraction of the states backed up per round (prioritized)
+    evaluation_steps = 20 # sweeps of each partial policy evaluation (modified)
+    evaluation_tolerance = 0.1 # ... stopped when they move V less than that
+                               # fraction of the last improvement
+
     def __init__(self, dungeon: Dungeon, name: str= 'MDP'):
         super().__init__(dungeon, name)
-        n_states = State.max_id + 1
+        n_states = self.space.n_states
         self.P = np.zeros(n_states) - 1
         self.gamma = 0.9
         self.epsilon = 10e-5
+        self.model = None, None # complete models of the dungeon (T, R)
+        self.T, self.R, self.V = None, None, None
+        self.iterations = 0 # sweeps of the last value iteration
         self.reset()
 
     # ───────────────────────── configure the agent ────────────────────────── #
     def reset(self):
+        """
+        Updates the model to the current map of the dungeon: loaded from the
+        model cache, or only the transitions and rewards impacted by the cells
+        that changed are recomputed. The policy is then computed again from
+        the last values.
+
+        The values, policy and models used by the solvers (V, P, T, R) are
+        indexed by the compact ids of the reachable states (see StateIndex).
+        """
+        last = self.index # the states of the last values
         super().reset()
-        self.T = self.dungeon.make_transition_matrix()
-        self.R = self.dungeon.make_reward_matrix(self.T)
-        self.V, self.P = self.value_iteration()
+        if self.matrix_free:
+            T = self.dungeon.make_operator()
+            R = self.dungeon.make_reward_matrix(T)
+            index = StateIndex.full(T.n_states) # every state
+        else:
+            T, R = self.model = self.dungeon.make_model(*self.model)
+            index = self.dungeon.state_index if self.compact else StateIndex.full(T.n_states)
+            T = T.restrict(index) if self.compact else T
+        # ──────────── warm start from the values of the last map ──────────── #
+        V = None
+        if self.V is not None and last.n_states == index.n_states:
+            V = index.gather(last.scatter(self.V))
+        self.T, self.R, self.index = T, index.gather(R), index
+        self.V, self.P = self.solve(V)
         # self.V, self.P = self.policy_iteration()
 
+    def solve(self, V: np.array= None):
+        """
+        Computes the values and policy of the current model (see reset): the
+        agents choose their algorithm by overriding it
+        """
+        return self.value_iteration(V)
+
+    def setup(self):
+        """ Computes the policy again, from the current values """
+        self.V, self.P = self.solve(self.V)
+
     # ────────────────── test of the validity of that agent ────────────────── #
     @property
     def ready(self):
@@ -33,76 +81,364 @@ class MDP(Adventurer):
     # ──────────────────── play (decide the next action) ───────────────────── #
     def play(self, state: State):
         assert self.ready
-        return Direction.from_int(self.P[state.id])
+        return Direction.from_int(self.P[self.index.compact(state.id)])
+
+    def play_batch(self, states: np.array, rng: np.random.Generator= None):
+        assert self.ready
+        return self.P[self.index.compact(states)]
 
     # ────────────────────── value iteration algorithm ─────────────────────── #
-    def value_iteration(self):
+    def value_iteration(self, V: np.array= None):
         """
+        @param V: initial values (warm start), zeros if None
         @return V, P: two arrays of N x 1
                     - V: containing the estimated reward for each state
                     - P: containing the policy associated
         """
+        if self.solver == 'prioritized' and hasattr(self.T, 'rows'):
+            return self.prioritized_sweeping(V)
+        if self.solver == 'phases' and hasattr(self.T, 'rows'):
+            phases = self.item_phases()
+            if phases is not None:
+                return self.phase_decomposition(V, phases)
+            # else an item can be lost: the jacobi sweeps below
+        if self.solver in ('gauss-seidel', 'async') and hasattr(self.T, 'rows'):
+            return self.gauss_seidel(V, asynchronous=self.solver == 'async')
         # ────────────────────────── variables init ────────────────────────── #
-        n_states = State.max_id + 1
+        n_states = len(self.R)
 
         # ────────────────────────── matrices init ─────────────────────────── #
         R, T = self.R, self.T
         # Q = np.zeros((n_states, 4), np.float32)
-        lV = np.ones(n_states, np.float32)
-        V = np.zeros(n_states, np.float32)
+        if V is None or V.shape != (n_states,):
+            V = np.zeros(n_states, np.float32)
+        lV = V + 1
 
         # ──────────────────────────── main loop ───────────────────────────── #
         i = 0
         while not (np.abs(V - lV) < self.epsilon).all() and i < 10000:
             lV = V # lV is last V
-            Q = R + self.gamma * np.matmul(T, V)
+            Q = R + self.gamma * T.dot(V)
             V = np.amax(Q, axis=1)
             i += 1
+        self.iterations = i
         P = np.argmax(Q, axis=1)
         return V, P
 
+    # ────────────── in-place sweeps, from the rewarding states ────────────── #
+    def backward_layers(self):
+        """
+        Breadth-first search backward from the states with a positive reward
+        (items and victory), along the transitions: the predecessors of a
+        set of states are found with a single product T · 1_set
+
+        @return list of arrays of states: the states at distance 0, 1, ... of
+                the rewards, then the states that never reach one
+        """
+        n_states = len(self.R)
+        layer = np.full(n_states, -1)
+        frontier = self.R.max(axis=1) > 0
+        d = 0
+        while frontier.any():
+            layer[frontier] = d
+            reached = (self.T.dot(frontier.astype(np.float64)) > 0).any(axis=1)
+            frontier = reached & (layer < 0)
+            d += 1
+        layer[layer < 0] = d
+        order = np.argsort(layer, kind='stable')
+        return np.split(order, np.cumsum(np.bincount(layer))[:-1])
+
+    def gauss_seidel(self, V: np.array= None, asynchronous: bool= False):
+        """
+        Value iteration updating the values in place, layer by layer of
+        backward_layers: the states closest to the rewards are backed up
+        first, and every layer uses the values already updated in the sweep.
+        On long maps the values travel the whole map in a single sweep,
+        instead of one cell per iteration. As in Gauss-Seidel, the loop of
+        each state on itself is solved exactly (staying on the start with the
+        treasure, bumping into a border):
+
+            V(s) = max_a (R(s, a) + γ Σ_{s' ≠ s} T(s, a, s') V(s')) / (1 - γ T(s, a, s))
+
+        @param V: initial values (warm start), zeros if None
+        @param asynchronous: bool= skip the layers whose successors did not
+                             change since their last backup
+        @return V, P: as value_iteration
+        """
+        n_states, n_actions = self.R.shape
+        R, T, gamma = self.R, self.T, self.gamma
+        V = np.zeros(n_states) if V is None or V.shape != (n_states,) else V.astype(np.float64)
+        # ────────────── the transitions, rows sorted by layer ─────────────── #
+        layers = self.backward_layers()
+        order = np.concatenate(layers)
+        bounds = np.cumsum([0] + [len(layer) for layer in layers])
+        rows = [T.rows(a, order).tocsr() for a in range(n_actions)]
+        loops = np.zeros((n_states, n_actions)) # T(s, a, s)
+        for (a, M) in enumerate(rows):
+            state = np.repeat(order, np.diff(M.indptr))
+            on = M.indices == state
+            loops[:, a] = np.bincount(state[on], M.data[on], n_states)
+        blocks = [[M[lo:hi] for M in rows] for (lo, hi) in zip(bounds[:-1], bounds[1:])]
+        # layers whose values are used by each layer (asynchronous sweeps)
+        layer_of = np.repeat(np.arange(len(layers)), np.diff(bounds))[np.argsort(order)]
+        uses = [np.bincount(layer_of[np.concatenate([M.indices for M in block])],
+                            minlength=len(layers)) > 0 for block in blocks] \
+               if asynchronous else None
+        moved = np.ones(len(layers), bool) # changed at their last backup
+        # ──────────────────────────── main loop ───────────────────────────── #
+        i, delta = 0, np.inf
+        while delta >= self.epsilon and i < 10000:
+            delta = 0
+            for (h, (layer, block)) in enumerate(zip(layers, blocks)):
+                if asynchronous and not moved[uses[h]].any():
+                    moved[h] = False
+                    continue
+                loop = loops[layer]
+                W = np.stack([M.dot(V) for M in block], axis=1) - loop * V[layer, None]
+                Q = (R[layer] + gamma * W) / (1 - gamma * loop)
+                change = np.abs(Q.max(axis=1) - V[layer]).max(initial=0)
+                V[layer] = Q.max(axis=1)
+                moved[h] = change >= self.epsilon
+                delta = max(delta, change)
+            i += 1
+        self.iterations = i
+        P = np.argmax(R + self.gamma * T.dot(V), axis=1)
+        return V, P
+
+    # ───────────── back up the states whose successors changed ────────────── #
+    def prioritized_sweeping(self, V: np.array= None):
+        """
+        Value iteration backing up, at each round, the states of largest
+        priority (the priority queue is an array, its largest values found
+        with a partial sort). The loop of each state on itself is solved
+        exactly, as in gauss_seidel, and the priority of a state bounds the
+        change of its backup: it is reset by a backup, and raised by
+        max_a γ T(s, a, s') / (1 - γ T(s, a, s)) |ΔV(s')| when a successor
+        s' ≠ s changes, through the index of the predecessors. The work
+        concentrates where the values are still moving.
+
+        @param V: initial values (warm start), zeros if None
+        @return V, P: as value_iteration
+        """
+        n_states, n_actions = self.R.shape
+        R, T, gamma = self.R, self.T, self.gamma
+        V = np.zeros(n_states) if V is None or V.shape != (n_states,) else V.astype(np.float64)
+        states = np.arange(n_states)
+        rows = [T.rows(a, states).tocsr() for a in range(n_actions)]
+        loops = np.stack([M.diagonal() for M in rows], axis=1) # T(s, a, s)
+        stacked = sparse.vstack(rows).tocsr() # row a * N + s: T(s, a, .)
+
+        def backup(S):
+            W = stacked[np.add.outer(np.arange(n_actions) * n_states, S).ravel()]
+            W = W.dot(V).reshape(n_actions, -1).T - loops[S] * V[S, None]
+            return ((R[S] + gamma * W) / (1 - gamma * loops[S])).max(axis=1)
+
+        # ─────────── predecessors of every state, and priorities ──────────── #
+        # column s': max_a γ T(s, a, s') / (1 - γ T(s, a, s)), the self-loop
+        # being solved by the backup of s
+        weights = [sparse.diags(gamma / (1 - gamma * loops[:, a]))
+                   .dot(M - sparse.diags(M.diagonal())) for (a, M) in enumerate(rows)]
+        predecessors = weights[0]
+        for W in weights[1:]:
+            predecessors = predecessors.maximum(W)
+        predecessors = predecessors.tocsc()
+        priority = np.abs(backup(states) - V)
+        batch = max(1, int(n_states * self.priority_batch))
+        # ──────────────────────────── main loop ───────────────────────────── #
+        i, self.backups = 0, n_states
+        while i < 100000:
+            top = np.argpartition(-priority, batch - 1)[:batch] if batch < n_states else states
+            top = top[priority[top] >= self.epsilon]
+            if not len(top):
+                break
+            new = backup(top)
+            delta = np.abs(new - V[top])
+            V[top] = new
+            priority[top] = 0
+            moved = delta > 0
+            priority += predecessors[:, top[moved]].dot(delta[moved])
+            self.backups += len(top)
+            i += 1
+        self.iterations = i
+        P = np.argmax(R + gamma * T.dot(V), axis=1)
+        return V, P
+
+    # ─────────── backward over the item phases (sword, treasure) ──────────── #
+    def item_phases(self):
+        """
+        The items are never lost (the sword goes 0 → 1, the treasure 0 → 1 →
+        2): the model is block triangular over the phases of items (and
+        death), that can be solved one after the other, from the last one.
+
+        @return list of arrays of states, one per phase, in the order in which
+                they can be solved (death, then by decreasing treasure and
+                sword), or None if a transition goes back to an earlier phase
+        """
+        space = self.space
+        death = space.swords * space.treasures
+        blocks = self.index.states // space.cells
+        order = sorted(np.unique(blocks).tolist(), key=lambda b: (b != death,
+                       -(b % space.treasures), -(b // space.treasures)))
+        rank = np.zeros(death + 1, np.int64)
+        rank[order] = np.arange(len(order))
+        rank = rank[blocks] # rank of the phase of every state
+        states = np.arange(len(blocks))
+        for a in range(self.R.shape[1]):
+            M = self.T.rows(a, states).tocoo()
+            if (rank[M.col] > rank[M.row]).any():
+                return None
+        return [np.flatnonzero(blocks == b) for b in order]
+
+    def phase_decomposition(self, V: np.array= None, phases: list= None):
+        """
+        Value iteration phase by phase (see item_phases), each phase being a
+        small MDP over the positions: the values of the later phases it leads
+        to are already known, and only add a constant reward. As in
+        gauss_seidel, the loop of each state on itself is solved exactly.
+
+        @param V: initial values (warm start), zeros if None
+        @param phases: list of arrays of states (item_phases if None)
+        @return V, P: as value_iteration
+        """
+        n_states, n_actions = self.R.shape
+        R, T, gamma = self.R, self.T, self.gamma
+        V = np.zeros(n_states) if V is None or V.shape != (n_states,) else V.astype(np.float64)
+        phases = self.item_phases() if phases is None else phases
+        self.iterations = self.backups = 0
+        for S in phases:
+            # --------- transitions inside the phase, and leaving it --------- #
+            rows = [T.rows(a, S).tocsr() for a in range(n_actions)]
+            inside = [M[:, S] for M in rows]
+            loops = np.stack([M.diagonal() for M in inside], axis=1) # T(s, a, s)
+            outside = V.copy()
+            outside[S] = 0 # values of the later phases only
+            C = R[S] + gamma * np.stack([M.dot(outside) for M in rows], axis=1)
+            # ----------------- value iteration on the phase ----------------- #
+            VS, i, delta = V[S], 0, np.inf
+            while delta >= self.epsilon and i < 10000:
+                W = np.stack([M.dot(VS) for M in inside], axis=1) - loops * VS[:, None]
+                new = ((C + gamma * W) / (1 - gamma * loops)).max(axis=1)
+                delta = np.abs(new - VS).max(initial=0)
+                VS = new
+                i += 1
+            V[S] = VS
+            self.iterations += i
+            self.backups += i * len(S)
+        P = np.argmax(R + gamma * T.dot(V), axis=1)
+        return V, P
+
     # ────────────────────── policy iteration algorithm ────────────────────── #
-    def policy_iteration(self):
+    def policy_iteration(self, V: np.array= None):
         """
+        @param V: initial values (warm start): the first policy is greedy on
+                  them, random if None
         @return V, P: two arrays of N x 1
                     - V: containing the estimated reward for each state
                     - P: containing the policy associated
         """
         # ────────────────────────── variables init ────────────────────────── #
-        n_states = State.max_id + 1
+        n_states = len(self.R)
 
         # ────────────────────────── matrices init ─────────────────────────── #
         R, T = self.R, self.T
-        I = np.identity(n_states)
-        lP = np.zeros(n_states, np.int8) - 1 # last policy
-        P = np.random.randint(4, dtype=np.int8, size=n_states) # random
-        
-        V = np.zeros(n_states, np.float32)
-        Q = np.ones((n_states, 4), np.float32)
-        lQ = np.zeros((n_states, 4), np.float32)
+        if V is None or V.shape != (n_states,):
+            P = np.random.randint(4, dtype=np.int8, size=n_states) # random
+            V = np.zeros(n_states)
+        else:
+            P = rand_argmax(R + self.gamma * T.dot(V), 1)
 
         # ──────────────────────────── main loop ───────────────────────────── #
         i = 0
-        while not (lP == P).all() and (np.amax(Q, 1) > np.amax(lQ, 1)).any() \
-                and i < 10000:
-            lP, lQ = P, Q
-            Ts = T[np.arange(n_states), P, :] # Transitions of current Policy
-            Rs = R[np.arange(n_states), P]
-            V = np.linalg.solve(self.gamma * Ts - I, -Rs)
-            Q = R + self.gamma * np.matmul(T, V)
+        while i < 10000:
+            V = self.evaluate_policy(P, V) # from the values of the last policy
+            Q = R + self.gamma * T.dot(V)
+            i += 1
+            if (np.amax(Q, 1) <= V + self.epsilon).all():
+                break # no action improves on the policy anymore
             P = rand_argmax(Q, 1)
+        self.iterations = i
+        return V, P
+
+    def evaluate_policy(self, P: np.array, V: np.array= None):
+        """
+        Exact values of a policy, the solution of (I - γ Ts) V = Rs, found by
+        BiCGSTAB on the sparse transitions of the policy (only the products
+        Ts · V are needed, never I - γ Ts itself), from an initial guess. The
+        residual is brought below ε (1 - γ), so that V is within ε of the
+        solution. A sparse LU is the fallback, if it doesn't converge.
+
+        @param P: array of N actions, the policy
+        @param V: initial guess (the values of the last policy), zeros if None
+        @return V: array of N values
+        """
+        n_states = len(self.R)
+        Ts, Rs = self.T.policy(P), self.R[np.arange(n_states), P]
+        A = LinearOperator(Ts.shape, lambda x: x - self.gamma * Ts.dot(x), dtype=np.float64)
+        V, info = bicgstab(A, Rs, x0=V, rtol=0, atol=self.epsilon * (1 - self.gamma))
+        if info != 0 and sparse.issparse(Ts):
+            I = sparse.identity(n_states, format='csc')
+            V = spsolve((I - self.gamma * Ts).tocsc(), Rs)
+        return V
+
+    # ────────── policy iteration, with partial policy evaluations ─────────── #
+    def modified_policy_iteration(self, V: np.array= None, k: int= None):
+        """
+        Policy iteration evaluating each policy with at most k sweeps of
+        V ← Rs + γ Ts V instead of solving it exactly: k = 1 is the value
+        iteration, k = ∞ the policy iteration. The sweeps stop as soon as they
+        move V by less than evaluation_tolerance times the change of the last
+        improvement, and the whole by the same criterion as value_iteration.
+
+        @param V: initial values (warm start), zeros if None
+        @param k: int= maximum sweeps per evaluation (evaluation_steps if None)
+        @return V, P: as value_iteration
+        """
+        # ────────────────────────── variables init ────────────────────────── #
+        n_states = len(self.R)
+        k = self.evaluation_steps if k is None else k
+        R, T, gamma = self.R, self.T, self.gamma
+        states = np.arange(n_states)
+        if V is None or V.shape != (n_states,):
+            V = np.zeros(n_states)
+
+        # ──────────────────────────── main loop ───────────────────────────── #
+        i, self.sweeps, lP = 0, 0, None
+        while i < 10000:
+            # ------------------------- improvement -------------------------- #
+            Q = R + gamma * T.dot(V)
+            P = np.argmax(Q, axis=1)
+            lV, V = V, Q[states, P]
+            change = np.abs(V - lV).max()
             i += 1
+            if change < self.epsilon:
+                break
+            # ---------------------- partial evaluation ---------------------- #
+            if k == 1:
+                continue
+            if lP is None or (P != lP).any(): # the same policy is kept later on
+                Ts, Rs, lP = T.policy(P), R[states, P], P
+            for _ in range(k - 1):
+                lV, V = V, Rs + gamma * Ts.dot(V)
+                self.sweeps += 1
+                if np.abs(V - lV).max() < self.evaluation_tolerance * change:
+                    break
+        self.iterations = i
         return V, P
 
 class ValueMDP(MDP):
     """ MDP using the value iteration for its policy """
-    def setup(self):
-        self.V, self.P = self.value_iteration()
+    def solve(self, V: np.array= None):
+        return self.value_iteration(V)
 
 class PolicyMDP(MDP):
     """ MDP using the policy iteration for its policy """
-    def setup(self):
-        self.V, self.P = self.policy_iteration()
+    def solve(self, V: np.array= None):
+        return self.policy_iteration(V)
+
+class ModifiedPolicyMDP(MDP):
+    """ MDP using the modified policy iteration (partial evaluations) """
+    def solve(self, V: np.array= None):
+        return self.modified_policy_iteration(V)
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,91 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .kernel import Dungeon
+from .states import StateIndex
+from .dungeon_map import Direction
+from scipy import sparse
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+class MultiMapSolver(object):
+    """
+    Value iteration of many maps of the same size at once.
+
+    The model of every map is built by a single Dungeon (whose map is
+    swapped), and the models are laid out block diagonally: the states
+    reachable on every map are searched at once, and the four actions of
+    every map are stacked in one sparse matrix, so that a sweep over all
+    the maps is a single product.
+    The sweeps go on until every map has converged (the same criterion as
+    MDP.value_iteration, map by map).
+    """
+
+    def __init__(self, maps: list, p_enemy: float= None, gamma: float= 0.9,
+            epsilon: float= 10e-5):
+        """
+        @param maps: list of k DungeonMap, all of the same size
+        @param p_enemy: float= probability to win a fight (Dungeon.p_enemy if None)
+        @param gamma, epsilon: as in MDP
+        """
+        n, m = maps[0].n, maps[0].m
+        assert all((d_map.n, d_map.m) == (n, m) for d_map in maps), "maps of the same size"
+        self.n, self.m, self.k = n, m, len(maps)
+        self.gamma, self.epsilon = gamma, epsilon
+        builder = Dungeon(n, m, 0)
+        if p_enemy is not None:
+            builder.p_enemy = p_enemy
+        n_full = builder.space.n_states # states of a map
+        # ───────────────── the complete model of every map ────────────────── #
+        blocks, R = [[] for _ in Direction], []
+        for d_map in maps:
+            builder.map = d_map
+            T = builder.make_transition_matrix()
+            R.append(builder.make_reward_matrix(T))
+            for (a, M) in enumerate(T.expand().matrices):
+                blocks[a].append(M)
+        blocks = [sparse.block_diag(M, format='csr') for M in blocks]
+        # ───── states reachable on every map, at once (block diagonal) ────── #
+        first = np.arange(self.k) * n_full
+        seen = np.zeros(self.k * n_full, bool)
+        seen[first + n_full - 1] = True # death
+        frontier = np.zeros(self.k * n_full, bool)
+        frontier[first + builder.space.start] = True
+        successors = sum(blocks[1:], blocks[0]).T.tocsr() # s' ← s
+        while frontier.any():
+            seen |= frontier
+            frontier = (successors.dot(frontier.astype(np.float64)) > 0) & ~seen
+        # ───────── restricted models, the actions stacked (4N x N) ────────── #
+        kept = np.flatnonzero(seen)
+        self.owner, self.states = np.divmod(kept, n_full) # map, complete id
+        self.offsets = np.searchsorted(self.owner, np.arange(self.k)) # first state of every map
+        self.indices = [StateIndex(states, n_full) for states in np.split(self.states, self.offsets[1:])]
+        self.R = np.concatenate(R)[kept]
+        self.T = sparse.vstack([M[kept][:, kept] for M in blocks], format='csr')
+        self.iterations = np.zeros(self.k, np.int64)
+
+    # ──────────────────── shared value iteration sweeps ───────────────────── #
+    def solve(self):
+        """
+        @return V, P: two arrays k x N, indexed by the complete state ids of
+                      each map (see StateSpace), the states that can't be reached
+                      being given a value of 0 and an action of -1
+        """
+        n_states, n_actions = self.R.shape
+        n_full = self.indices[0].n_states # states of a map
+        V = np.zeros(n_states)
+        active = np.ones(self.k, bool) # maps still moving
+        i = 0
+        while active.any() and i < 10000:
+            Q = self.R + self.gamma * self.T.dot(V).reshape(n_actions, n_states).T
+            new = Q.max(axis=1)
+            delta = np.maximum.reduceat(np.abs(new - V), self.offsets)
+            V = new
+            i += 1
+            self.iterations[active] = i
+            active &= delta >= self.epsilon
+        P = np.argmax(Q, axis=1)
+        # ─────────────── back to the complete ids, map by map ─────────────── #
+        V_maps = np.zeros((self.k, n_full))
+        P_maps = np.full((self.k, n_full), -1, np.int64)
+        V_maps[self.owner, self.states] = V
+        P_maps[self.owner, self.states] = P
+        return V_maps, P_maps
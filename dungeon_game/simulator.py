@@ -0,0 +1,100 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .states import State, StateIndex, StateSpace
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+class ModelSimulator(object):
+    """
+    Simulator of the transition model of a dungeon, compiled into sampling
+    tables.
+
+    The successors of every (state, action) are stored with their cumulative
+    probabilities as 32 bits integers, every row shifted by its number, so
+    that the tables of all the rows form a single sorted array: sampling the
+    next state of K episodes is a single binary search of K random integers.
+
+    An episode is won when it enters the start with the treasure, lost when it
+    dies, exactly as in the model the MDP is solved on.
+    """
+
+    precision = 32 # bits of the integer probabilities
+
+    def __init__(self, T, index: StateIndex= None, space: StateSpace= None):
+        """
+        @param T: the transition model (SparseTransition or FactoredTransition),
+                  MDP.T for instance
+        @param index: StateIndex= the index T is restricted to (every state if None)
+        @param space: StateSpace= the states of the dungeon (the default one if None)
+        """
+        space = State.default if space is None else space
+        self.n_states, self.n_actions = T.n_states, T.n_actions
+        index = StateIndex.full(T.n_states) if index is None else index
+        assert len(index) == self.n_states
+        # ────────────────── terminal states : won, or dead ────────────────── #
+        sword, treasure, position = space.decode(index.states)
+        self.won = (treasure == 2) & (position == space.cells - 1)
+        self.won[-1] = False # death is not a real position
+        self.terminal = self.won.copy()
+        self.terminal[-1] = True # death
+        self.start = index.compact(space.start)
+        # ─────────────────── one row per (state, action) ──────────────────── #
+        states = np.arange(self.n_states)
+        rows, cols, probs = [], [], []
+        for a in range(self.n_actions):
+            Ta = T.rows(a, states).tocoo()
+            keep = Ta.data > 0
+            rows.append(Ta.row[keep] * self.n_actions + a)
+            cols.append(Ta.col[keep])
+            probs.append(Ta.data[keep])
+        rows, cols, probs = [np.concatenate(x) for x in (rows, cols, probs)]
+        order = np.lexsort((cols, rows))
+        rows, cols, probs = rows[order], cols[order], probs[order]
+        # ────────────── cumulative probabilities, as integers ─────────────── #
+        one = 1 << self.precision
+        cumul = np.cumsum(probs, dtype=np.longdouble)
+        first = np.r_[True, rows[1:] != rows[:-1]]
+        offset = np.maximum.accumulate(np.where(first, cumul - probs, 0))
+        total = np.zeros(self.n_states * self.n_actions)
+        np.add.at(total, rows, probs)
+        cumul = np.round((cumul - offset) / total[rows] * one).astype(np.int64)
+        cumul[np.r_[rows[1:] != rows[:-1], True]] = one # every row sums to 1
+        self.table = (rows.astype(np.int64) << self.precision) + cumul
+        self.successors = cols
+
+    # ─────────────────────────── sample the model ─────────────────────────── #
+    def sample(self, states: np.array, actions: np.array, rng: np.random.Generator):
+        """
+        @param states, actions: two arrays of k (compact) states and actions
+        @return array of k next states, drawn from the transition model
+        """
+        rows = states.astype(np.int64) * self.n_actions + actions
+        u = rng.integers(0, 1 << self.precision, size=len(rows))
+        return self.successors[np.searchsorted(self.table, (rows << self.precision) + u, 'right')]
+
+    def run(self, policy: np.array, k: int, max_steps: int= 10000, seed: int= None):
+        """
+        Plays k episodes following a fixed policy, until they are over (or
+        max_steps are played)
+
+        @param policy: the action of each state (MDP.P for instance), or a
+                       Q-table (its greedy policy is played)
+        @return wins, steps: two arrays of k
+                    - wins: True if the episode was won
+                    - steps: number of steps played in the episode
+        """
+        policy = np.asarray(policy)
+        if policy.ndim == 2:
+            policy = np.argmax(policy, axis=1)
+        policy = policy.astype(np.int64)
+        rng = np.random.default_rng(seed)
+        states = np.full(k, self.start)
+        steps = np.zeros(k, np.int64)
+        playing = np.arange(k)
+        for _ in range(max_steps):
+            if not len(playing):
+                break
+            s = self.sample(states[playing], policy[states[playing]], rng)
+            states[playing] = s
+            steps[playing] += 1
+            playing = playing[~self.terminal[s]]
+        return self.won[states], steps
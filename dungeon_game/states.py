@@ -1,23 +1,100 @@
 # ───────────────────────────────── imports ────────────────────────────────── #
-pass
+import numpy as np
 # ──────────────────────────────────────────────────────────────────────────── #
 
+class StateSpace(object):
+    """
+    The states of a dungeon of n x m cells: every (sword, treasure, position),
+    then death (the last id).
+
+    Every dungeon owns its own space (Dungeon.space), and the ids of its
+    states are only converted by it: any number of dungeons, of any size,
+    can coexist in a process (or its threads).
+    """
+
+    swords = 2
+    treasures = 3
+
+    def __init__(self, n: int, m: int):
+        self.n, self.m, self.cells = n, m, n * m
+        self.max_id = n * m * self.swords * self.treasures # account for death
+        self.n_states = self.max_id + 1
+        # offsets[sword][treasure]: id of (sword, treasure, position 0)
+        self.offsets = [[(sw * self.treasures + tr) * n * m for tr in range(self.treasures)]
+                        for sw in range(self.swords)]
+        self.start = n * m - 1 # id of the starting state, no item on the start
+        self.tables = None # (sword, treasure, position) of every id, see decode
+
+    def state(self, sword: int= None, treasure: int= None, position: int= None,
+            s_id: int= None):
+        """ a State of this space (see State) """
+        return State(sword, treasure, position, s_id, space=self)
+
+    # ──────────────── static conversions : state <--> values ──────────────── #
+    def id_to_state(self, s_id: int):
+        position = s_id % self.cells
+        treasure = (s_id // self.cells) % self.treasures
+        sword = (s_id // (self.cells * self.treasures)) % self.swords
+        return sword, treasure, position
+
+    def state_to_id(self, sword: int, treasure: int, position: int):
+        return (sword * self.treasures + treasure) * self.cells + position
+
+    # ──────────────────── vectorized, for arrays of ids ───────────────────── #
+    def encode(self, sword: np.array, treasure: np.array, position: np.array):
+        """ arrays of (sword, treasure, position) → array of ids """
+        sword, treasure = np.asarray(sword, np.int64), np.asarray(treasure, np.int64)
+        return (sword * self.treasures + treasure) * self.cells + position
+
+    def decode(self, s_id: np.array):
+        """
+        array of ids → arrays of (sword, treasure, position), looked up in
+        tables built once per space (as id_to_state does)
+        """
+        if self.tables is None:
+            ids = np.arange(self.n_states)
+            block, position = np.divmod(ids, self.cells)
+            sword, treasure = np.divmod(block, self.treasures)
+            sword %= self.swords # death
+            self.tables = (sword.astype(np.int8), treasure.astype(np.int8),
+                           position.astype(np.int32 if self.cells < 2 ** 31 else np.int64))
+        return tuple(table[s_id] for table in self.tables)
+
 class State(object):
-    """ State of the MDP as designed in the dungeon """
+    """
+    State of the MDP as designed in the dungeon
+
+    A state is its id only: the sword, treasure and position are decoded from
+    it when read, and a single new id is encoded when one of them is written,
+    by the space of the state (see StateSpace). The states created without a
+    space belong to the default one, the space of the last dungeon created or
+    reset (and so do the static attributes and conversions below).
+    """
+
+    __slots__ = ('id', 'index', 'space') # index: compact id (see StateIndex), -1 if unknown
 
     # ────────────────────────── static attributes ─────────────────────────── #
+    default = None # default StateSpace
     n, m, max_id = 0, 0, 0
-    swords = 2
-    treasures = 3
+    cells = 0 # n * m
+    swords = StateSpace.swords
+    treasures = StateSpace.treasures
+    offsets = None # offsets[sword][treasure]: id of (sword, treasure, position 0)
 
-    def configure(n: int, m: int):
-        """ Configures the static parameters of the class """
-        State.n, State.m = n, m
-        State.max_id = n * m * State.swords * State.treasures # account for death
+    def configure(n, m: int= None):
+        """
+        Sets the default space (and the static attributes of the class)
+
+        @param n, m: the size of the dungeon, or n a StateSpace
+        """
+        space = n if isinstance(n, StateSpace) else StateSpace(n, m)
+        State.default = space
+        State.n, State.m, State.cells = space.n, space.m, space.cells
+        State.max_id, State.offsets = space.max_id, space.offsets
 
     # ───────────────────────────── constructor ────────────────────────────── #
     def __init__(self, sword: int = None, treasure: int = None, position: int = None,
-                 s_id: int = None):
+                 s_id: int = None, space: StateSpace= None):
         """
         Creates a state object. Two way to initialze:
             - Using the 3 separate values composing a state:
@@ -27,84 +104,147 @@ class State(object):
             - Using the state id:
 
                 State(s_id=14) # must use the keyword
+
+        The state belongs to space (the default space if None).
         """
         assert (sword is not None and treasure is not None and position is not None) or \
                s_id is not None
-        self.__sword, self.__treasure, self.__position, self.__id = -1, -1, -1, -1
+        self.space = State.default if space is None else space
         if s_id is not None:
-            self.id = s_id
-            # self.sword, self.treasure, self.position = State.id_to_state(s_id)
+            self.id = int(s_id)
         else:
-            # self.sword, self.treasure, self.position = sword, treasure, position
-            self.id = State.state_to_id(sword, treasure, position)
-
-    # ─────────────────── use getters for the same reason ──────────────────── #
-    @property
-    def sword(self): return self.__sword
+            self.id = self.space.offsets[sword][treasure] + position
+        self.index = -1
 
+    # ─────────────────── values decoded from the id only ──────────────────── #
     @property
-    def treasure(self): return self.__treasure
+    def sword(self): return self.id // (self.space.cells * State.treasures) % State.swords
 
     @property
-    def position(self): return self.__position
+    def treasure(self): return self.id // self.space.cells % State.treasures
 
     @property
-    def id(self): return self.__id
+    def position(self): return self.id % self.space.cells
 
-    # ──────────────── use setters to garanty value coherency ──────────────── #
     @sword.setter
     def sword(self, value: int):
-        self.__sword = value
-        self.__id = State.state_to_id(self.sword, self.treasure, self.position)
+        self.id = self.space.offsets[value][self.treasure] + self.position
 
     @treasure.setter
     def treasure(self, value: int):
-        self.__treasure = value
-        self.__id = State.state_to_id(self.sword, self.treasure, self.position)
+        self.id = self.space.offsets[self.sword][value] + self.position
 
     @position.setter
     def position(self, value: int):
-        self.__position = value
-        self.__id = State.state_to_id(self.sword, self.treasure, self.position)
+        self.id += value - self.position
 
-    @id.setter
-    def id(self, value: int):
-        self.__id = value
-        self.__sword, self.treasure, self.position = State.id_to_state(value)
-
-    # ──────────────── static conversions : state <--> values ──────────────── #
+    # ─────────────── static conversions, in the default space ─────────────── #
     @staticmethod
     def id_to_state(s_id: int):
-        position = s_id % (State.n * State.m)
-        treasure = (s_id // (State.n * State.m)) % State.treasures
-        sword = (s_id // (State.n * State.m * State.treasures)) % State.swords
-        return sword, treasure, position
+        return State.default.id_to_state(s_id)
 
     @staticmethod
     def state_to_id(sword: int, treasure: int, position: int):
-        n, m = State.n, State.m
-        return sword * State.treasures * n * m + treasure * n * m + position
+        return State.default.state_to_id(sword, treasure, position)
+
+    @staticmethod
+    def encode(sword: np.array, treasure: np.array, position: np.array):
+        """ arrays of (sword, treasure, position) → array of ids """
+        return State.default.encode(sword, treasure, position)
+
+    @staticmethod
+    def decode(s_id: np.array):
+        """ array of ids → arrays of (sword, treasure, position) """
+        return State.default.decode(s_id)
 
     # ───────────────────────── some usefull getters ───────────────────────── #
     @property
     def i(self):
-        return self.position // State.m
+        return self.position // self.space.m
 
     @property
     def j(self):
-        return self.position % State.m
+        return self.position % self.space.m
 
     @i.setter
     def i(self, v: int):
-        self.position = v * State.m + self.j
+        self.position = v * self.space.m + self.j
 
     @j.setter
     def j(self, v: int):
-        self.position = self.i + v
+        self.position = self.i * self.space.m + v
 
     def __str__(self):
         sw = '理'
         tr = 'ﰤ'
         return "<S: {} ,T: {} ,p: ({},{})>".format(sw[self.sword], tr[self.treasure], self.i, self.j)
 
+class StateIndex(object):
+    """
+    Compact index of the states of a dungeon that can actually be occupied.
 
+    The complete state space contains every (sword, treasure, position), even
+    the walls (that bounce back to the start), the cracks (that kill) and the
+    item combinations that can't be obtained. The index only keeps the states
+    reachable from the start, numbered from 0 to len(index) - 1 in the order
+    of their complete ids (death, always kept, is the last one).
+    """
+
+    def __init__(self, states: np.array, n_states: int):
+        """
+        @param states: sorted array of the complete ids to keep
+        @param n_states: size of the complete state space (death included)
+        """
+        self.states = np.asarray(states, np.int64) # compact → complete id
+        self.n_states = n_states
+        self.index = np.full(n_states, -1, np.int64) # complete → compact id
+        self.index[self.states] = np.arange(len(self.states))
+
+    @staticmethod
+    def full(n_states: int):
+        """ identity index, keeping every state """
+        return StateIndex(np.arange(n_states), n_states)
+
+    @staticmethod
+    def reachable(T, start: int):
+        """
+        Breadth-first search of the states reachable from start
+
+        @param T: the transition model of the dungeon (see transitions.py)
+        @param start: complete id of the starting state
+        """
+        seen = np.zeros(T.n_states, bool)
+        seen[[start, T.n_states - 1]] = True
+        frontier = np.array([start])
+        while len(frontier):
+            reached = []
+            for a in range(T.n_actions):
+                rows = T.rows(a, frontier)
+                rows.eliminate_zeros()
+                reached.append(rows.indices)
+            reached = np.unique(np.concatenate(reached))
+            frontier = reached[~seen[reached]]
+            seen[frontier] = True
+        return StateIndex(np.flatnonzero(seen), T.n_states)
+
+    # ────────────────────────── conversions of ids ────────────────────────── #
+    def __len__(self):
+        return len(self.states)
+
+    def compact(self, s_id):
+        """ complete id(s) → compact id(s), -1 for the states not indexed """
+        return self.index[s_id]
+
+    def complete(self, c_id):
+        """ compact id(s) → complete id(s) """
+        return self.states[c_id]
+
+    def scatter(self, values: np.array, fill: float= 0):
+        """ array indexed by compact ids → array indexed by complete ids """
+        complete = np.full((self.n_states,) + values.shape[1:], fill, values.dtype)
+        complete[self.states] = values
+        return complete
+
+    def gather(self, values: np.array):
+        """ array indexed by complete ids → array indexed by compact ids """
+        return values[self.states]
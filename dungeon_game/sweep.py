@@ -0,0 +1,168 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .mdp import MDP
+from .states import StateIndex
+from .transitions import FactoredTransition, SparseTransition
+from multiprocessing import Pool
+from scipy import sparse
+import numpy as np, csv
+# ──────────────────────────────────────────────────────────────────────────── #
+
+def solve_shard(job):
+    """
+    Solves a shard of the settings, in a worker process
+
+    @param job: (sweep, settings), see ParameterSweep.run
+    @return list of the results of those settings
+    """
+    sweep, settings = job
+    return sweep.solve(settings)
+
+class ParameterSweep(object):
+    """
+    Solves the MDP of a map for many settings of (p_enemy, gamma).
+
+    Only the stable markov chain depends on p_enemy, and linearly (a fight is
+    won with probability p): the model is built once, for p = 0 and p = 1, and
+    the transitions of every setting are interpolated, only the entries of
+    the fights being patched. The rewards don't depend on p_enemy (only the
+    certain moves are rewarded, never a fight).
+
+    Every setting is solved by the MDP agent of the dungeon (see MDP.solve),
+    from the values of the previous setting: the settings are ordered so
+    that it is always a neighbouring one.
+    """
+
+    def __init__(self, dungeon):
+        """
+        @param dungeon: Dungeon= the map studied, played by a single MDP agent
+        """
+        assert len(dungeon.agents) == 1 and isinstance(dungeon.agents[0], MDP)
+        self.dungeon, self.agent = dungeon, dungeon.agents[0]
+        n_cells = dungeon.n * dungeon.m
+        # ─────────── the grid moves once, the fights for p = 0, 1 ─────────── #
+        shared = 'p_enemy' in vars(dungeon) # else the class attribute
+        p_enemy = dungeon.p_enemy
+        dungeon.p_enemy = 0.5 # every fight can be won or lost
+        T = dungeon.make_transition_matrix()
+        chains = []
+        for p in (0, 1):
+            dungeon.p_enemy = p
+            chains.append(dungeon.markov_chain())
+        if shared:
+            dungeon.p_enemy = p_enemy
+        else:
+            del dungeon.p_enemy
+        # ────────────── reachable states, whatever p_enemy is ─────────────── #
+        self.start = dungeon.space.start
+        self.index = StateIndex.reachable(T, self.start)
+        self.R = self.index.gather(dungeon.make_reward_matrix(T))
+        won = self.index.compact(dungeon.space.encode(np.arange(dungeon.space.swords), 2, n_cells - 1))
+        self.won = won[won >= 0] # back to start with the treasure
+        # ──────── entries of both models, on their common structure ───────── #
+        lost, won = [FactoredTransition(T.moves, S).restrict(self.index).matrices
+                     for S in chains]
+        self.patterns = []
+        for (A, B) in zip(lost, won):
+            U = (abs(A) + abs(B)).tocsr()
+            U.sort_indices()
+            rows = np.repeat(np.arange(U.shape[0]), np.diff(U.indptr))
+            base = np.asarray(A[rows, U.indices]).ravel()
+            slope = np.asarray(B[rows, U.indices]).ravel() - base
+            fights = np.flatnonzero(slope) # entries depending on p_enemy
+            self.patterns.append((U.indices, U.indptr, base, fights, slope[fights]))
+
+    # ────────────────────── the model of each setting ─────────────────────── #
+    def transitions(self, p_enemy: float):
+        """
+        @param p_enemy: float= probability to win a fight
+        @return SparseTransition: the (compact) transitions for that p_enemy
+        """
+        n_states = len(self.index)
+        matrices = []
+        for (indices, indptr, base, fights, slope) in self.patterns:
+            data = base.copy()
+            data[fights] += p_enemy * slope
+            matrices.append(sparse.csr_matrix((data, indices, indptr),
+                                              shape=(n_states, n_states)))
+        return SparseTransition(matrices)
+
+    def win_probability(self, T: SparseTransition, P: np.array):
+        """
+        @param T: SparseTransition= the transitions of a setting
+        @param P: array of the actions of a policy, one per (compact) state
+        @return float: the probability to win a game following the policy
+        """
+        Ts, epsilon = T.policy(P), self.agent.epsilon
+        h = np.zeros(len(self.index)) # probability to win from each state
+        for _ in range(10000):
+            lh, h = h, Ts.dot(h)
+            h[self.won] = 1
+            if np.abs(h - lh).max() < epsilon: break
+        return h[self.index.compact(self.start)]
+
+    # ────────────────────────── solve the settings ────────────────────────── #
+    def solve(self, settings: list, V: np.array= None):
+        """
+        Solves some settings in a row, each one from the values of the last
+
+        @param settings: list of (p_enemy, gamma)
+        @param V: initial values of the first setting, zeros if None
+        @return list of dicts, one per setting:
+                    - 'p_enemy', 'gamma': the setting
+                    - 'value': the value of the starting state
+                    - 'win': the probability to win following the policy
+                    - 'iterations': iterations of the solver (see MDP)
+                    - 'V', 'P': the values and policy (compact states)
+        """
+        agent = self.agent
+        saved = agent.T, agent.R, agent.index, agent.gamma
+        agent.R, agent.index = self.R, self.index
+        start = self.index.compact(self.start)
+        results = []
+        try:
+            for (p_enemy, gamma) in settings:
+                agent.T, agent.gamma = self.transitions(p_enemy), gamma
+                V, P = agent.solve(V)
+                results.append({'p_enemy': p_enemy, 'gamma': gamma,
+                    'value': float(V[start]), 'win': float(self.win_probability(agent.T, P)),
+                    'iterations': agent.iterations, 'V': V, 'P': P})
+        finally:
+            agent.T, agent.R, agent.index, agent.gamma = saved
+        return results
+
+    def run(self, p_enemies: list, gammas: list, jobs: int= 1):
+        """
+        Solves every setting of the grid p_enemies x gammas
+
+        The settings are ordered by gamma, then by p_enemy in alternate
+        directions (two settings in a row are always neighbours), and split
+        in one shard of consecutive settings per job, solved by a pool of
+        processes.
+
+        @param jobs: int= number of worker processes
+        @return list of results (see solve), sorted by p_enemy and gamma
+        """
+        p_enemies = sorted(p_enemies)
+        settings = [(p, gamma) for (k, gamma) in enumerate(sorted(gammas))
+                    for p in (p_enemies if k % 2 == 0 else p_enemies[::-1])]
+        split = np.array_split(np.arange(len(settings)), min(jobs, len(settings)))
+        shards = [(self, [settings[k] for k in shard]) for shard in split]
+        if jobs == 1:
+            results = solve_shard(shards[0])
+        else:
+            with Pool(jobs) as pool:
+                results = sum(pool.map(solve_shard, shards), [])
+        return sorted(results, key=lambda r: (r['p_enemy'], r['gamma']))
+
+    @staticmethod
+    def write_table(results: list, path: str):
+        """
+        Writes the results of a sweep as a csv table: one line per setting,
+        the policy being the actions of the (compact) states, as digits
+        """
+        with open(path, 'w', newline='') as csvFile:
+            writer = csv.writer(csvFile)
+            writer.writerow(['p_enemy', 'gamma', 'value', 'win', 'iterations', 'policy'])
+            for r in results:
+                writer.writerow([r['p_enemy'], r['gamma'], r['value'], r['win'],
+                                 r['iterations'], ''.join(str(a) for a in r['P'])])
@@ -0,0 +1,427 @@
+# ───────────────────────────────── imports ────────────────────────────────── #
+from .states import State
+from scipy import sparse
+from scipy.sparse.linalg import LinearOperator
+import numpy as np
+# ──────────────────────────────────────────────────────────────────────────── #
+
+class SparseTransition(object):
+    """
+    Transition model T(s, a, s') of the dungeon, stored as one sparse (CSR)
+    matrix of size N x N per action.
+
+    Every state only leads to a handful of other states, so the memory needed
+    grows with the number of non-zero probabilities instead of N x 4 x N.
+    """
+
+    def __init__(self, matrices: list, grid: np.array= None,
+            teleport_distributions: dict= None):
+        """
+        @param matrices: list of the N x N transition matrices, one per action
+        @param grid: the layout of the map the model was built for (n x m
+                     array of cells), to be able to update it when the map
+                     changes
+        @param teleport_distributions: the distributions of the portals and
+                     platforms of that layout
+        """
+        self.matrices = [sparse.csr_matrix(T, dtype=np.float64) for T in matrices]
+        self.n_states = self.matrices[0].shape[0]
+        self.n_actions = len(self.matrices)
+        assert all(T.shape == (self.n_states, self.n_states) for T in self.matrices)
+        self.stacked = None # 4N x N, row a * N + s: T(s, a, .) (see policy)
+        self.grid = grid
+        self.teleport_distributions = teleport_distributions
+
+    # ────────────────────────── shape of the model ────────────────────────── #
+    @property
+    def shape(self):
+        return (self.n_states, self.n_actions, self.n_states)
+
+    @property
+    def nnz(self):
+        """ number of non-zero probabilities stored """
+        return sum(T.nnz for T in self.matrices)
+
+    # ────────────────────── access to the transitions ─────────────────────── #
+    def __getitem__(self, index):
+        """
+        T[s, a] returns the distribution over the next states, as a dense
+        vector of size N (convenient to display a single transition)
+        """
+        s, a = index
+        return self.matrices[a][s].toarray().ravel()
+
+    def rows(self, a: int, states: np.array):
+        """
+        @param a: int= the action
+        @param states: array of k states
+        @return sparse k x N matrix: the transitions of those states
+        """
+        return self.matrices[a][states]
+
+    def certain(self, states: np.array= None):
+        """
+        Finds the 'certain' transitions, the state-actions leading to a single
+        state with probability 1
+
+        @param states: array of k states to consider (every state if None)
+        @return certain, target: two arrays of k x 4
+                    - certain: True if (s, a) leads to a single state
+                    - target: the most likely next state of (s, a)
+        """
+        Ts = self.matrices if states is None else [T[states] for T in self.matrices]
+        best_p = np.stack([T.max(axis=1).toarray().ravel() for T in Ts], 1)
+        target = np.stack([np.asarray(T.argmax(axis=1)).ravel() for T in Ts], 1)
+        return best_p == 1, target
+
+    def todense(self):
+        """ returns the complete N x 4 x N array (only for small dungeons) """
+        return np.stack([T.toarray() for T in self.matrices], axis=1)
+
+    def restrict(self, index):
+        """
+        @param index: StateIndex= states to keep (closed under the transitions)
+        @return the model restricted to those states, renumbered by the index
+        """
+        return SparseTransition([T[index.states][:, index.states] for T in self.matrices],
+                                self.grid, self.teleport_distributions)
+
+    # ─────────────────────────── matrix products ──────────────────────────── #
+    def dot(self, V: np.array):
+        """
+        @param V: array of N values, one for each state
+        @return array N x 4: the expected value of the next state, Σ T(s, a, s') V(s')
+        """
+        return np.stack([T.dot(V) for T in self.matrices], axis=1)
+
+    def policy(self, P: np.array):
+        """
+        @param P: array of N actions, one for each state
+        @return sparse N x N matrix: the transitions when following the policy P
+        """
+        if self.stacked is None: # built once, a single row selection per policy
+            self.stacked = sparse.vstack(self.matrices, format='csr')
+        rows = np.asarray(P, np.int64) * self.n_states + np.arange(self.n_states)
+        return self.stacked[rows]
+
+class FactoredTransition(object):
+    """
+    Transition model T(s, a, s') of the dungeon, factored over the items.
+
+    Every move is done in two steps:
+        - G[a]: the move on the grid, a (n * m) x (n * m) matrix over the
+          positions only (teleportations included), the same for every
+          combination of items.
+        - S: entering the cell, the stable markov chain of the dungeon, that
+          holds the per-cell item rules (a handful of outcomes per state).
+    so that T[a] = diag(G[a], ..., G[a], 0) · S. This product is never
+    expanded: the position dynamics are stored once and every operation is
+    done block by block, one block per combination of items.
+    """
+
+    def __init__(self, moves: list, S: sparse.csr_matrix, grid: np.array= None,
+            teleport_distributions: dict= None):
+        """
+        @param moves: list of the (n * m) x (n * m) grid moves, one per action
+        @param S: N x N stable markov chain (the last state is death)
+        @param grid: the layout of the map the model was built for (n x m
+                     array of cells), to be able to update it when the map
+                     changes
+        @param teleport_distributions: the distributions of the portals and
+                     platforms of that layout
+        """
+        self.moves = [sparse.csr_matrix(G, dtype=np.float64) for G in moves]
+        self.S = sparse.csr_matrix(S, dtype=np.float64)
+        self.n_cells = self.moves[0].shape[0]
+        self.n_states = self.S.shape[0]
+        self.n_actions = len(self.moves)
+        self.blocks = (self.n_states - 1) // self.n_cells
+        assert self.blocks * self.n_cells + 1 == self.n_states
+        self.grid = grid
+        self.teleport_distributions = teleport_distributions
+
+    # ────────────────────────── shape of the model ────────────────────────── #
+    @property
+    def shape(self):
+        return (self.n_states, self.n_actions, self.n_states)
+
+    @property
+    def nnz(self):
+        """ number of non-zero probabilities stored """
+        return sum(G.nnz for G in self.moves) + self.S.nnz
+
+    # ────────────────────── access to the transitions ─────────────────────── #
+    def rows(self, a: int, states: np.array):
+        """
+        @param a: int= the action
+        @param states: array of k states
+        @return sparse k x N matrix: the transitions of those states (expanded)
+        """
+        states = np.asarray(states)
+        living = np.flatnonzero(states < self.n_states - 1)
+        b, p = np.divmod(states[living], self.n_cells)
+        G = self.moves[a][p].tocoo()
+        F = sparse.csr_matrix((G.data, (living[G.row], b[G.row] * self.n_cells + G.col)),
+                              shape=(len(states), self.n_states))
+        return F.dot(self.S)
+
+    def __getitem__(self, index):
+        """
+        T[s, a] returns the distribution over the next states, as a dense
+        vector of size N (convenient to display a single transition)
+        """
+        s, a = index
+        return self.rows(a, [s]).toarray().ravel()
+
+    def certain(self, states: np.array= None):
+        """
+        Finds the 'certain' transitions, the state-actions leading to a single
+        state with probability 1
+
+        @param states: array of k states to consider (every state if None)
+        @return certain, target: two arrays of k x 4
+                    - certain: True if (s, a) leads to a single state
+                    - target: that state, when certain
+        """
+        death = self.n_states - 1
+        states = np.arange(self.n_states) if states is None else np.asarray(states)
+        living = states < death
+        b, p = np.divmod(np.where(living, states, 0), self.n_cells)
+        # ────────────── certain outcomes of entering each cell ────────────── #
+        S_certain = self.S.max(axis=1).toarray().ravel() == 1
+        S_target = np.asarray(self.S.argmax(axis=1)).ravel()
+        S_death = self.S[:, death].toarray().ravel()[:-1]
+        S_death = S_death.reshape(self.blocks, self.n_cells).T
+        certain = np.zeros((len(states), self.n_actions), bool)
+        target = np.full((len(states), self.n_actions), death)
+        for (a, G) in enumerate(self.moves):
+            # a single cell entered, with a certain outcome
+            landing = b * self.n_cells + np.asarray(G.argmax(axis=1)).ravel()[p]
+            single = G.max(axis=1).toarray().ravel()[p] == 1
+            certain[:, a] = living & single & S_certain[landing]
+            target[:, a] = np.where(certain[:, a], S_target[landing], death)
+            # several cells entered can only certainly lead to death
+            dies = G.dot(S_death)[p, b] == 1
+            certain[:, a] |= living & dies
+        return certain, target
+
+    def todense(self):
+        """ returns the complete N x 4 x N array (only for small dungeons) """
+        return self.expand().todense()
+
+    def expand(self):
+        """ returns the (6 times larger) flat model, as a SparseTransition """
+        states = np.arange(self.n_states)
+        return SparseTransition([self.rows(a, states) for a in range(self.n_actions)],
+                                self.grid, self.teleport_distributions)
+
+    def restrict(self, index):
+        """
+        @param index: StateIndex= states to keep (closed under the transitions)
+        @return SparseTransition: the flat model restricted to those states,
+                renumbered by the index (only those rows are expanded)
+        """
+        return SparseTransition([self.rows(a, index.states)[:, index.states]
+                                 for a in range(self.n_actions)],
+                                self.grid, self.teleport_distributions)
+
+    # ─────────────────────────── matrix products ──────────────────────────── #
+    def dot(self, V: np.array):
+        """
+        @param V: array of N values, one for each state
+        @return array N x 4: the expected value of the next state, Σ T(s, a, s') V(s')
+
+        The value of entering each state is computed once (S · V), then every
+        grid move is applied to all the combinations of items at once.
+        """
+        W = self.S.dot(V)[:-1].reshape(self.blocks, self.n_cells).T
+        Q = np.zeros((self.n_states, self.n_actions), np.float64)
+        for (a, G) in enumerate(self.moves):
+            Q[:-1, a] = G.dot(W).T.ravel() # death stays at 0
+        return Q
+
+    def policy(self, P: np.array):
+        """
+        @param P: array of N actions, one for each state
+        @return sparse N x N matrix: the transitions when following the policy P
+        """
+        rows, cols, probs = [], [], []
+        for a in range(self.n_actions):
+            states = np.flatnonzero(P == a)
+            F = self.rows(a, states).tocoo()
+            rows.append(states[F.row])
+            cols.append(F.col)
+            probs.append(F.data)
+        rows, cols, probs = [np.concatenate(x) for x in (rows, cols, probs)]
+        return sparse.csr_matrix((probs, (rows, cols)), shape=(self.n_states, self.n_states))
+
+    # ───────────────────────── update of the model ────────────────────────── #
+    def patch(self, positions: np.array, moves: list, S: sparse.csr_matrix):
+        """
+        Replaces (inplace) the grid moves of some positions, and the stable
+        markov chain
+
+        @param positions: array of k positions
+        @param moves: list of the k x (n * m) sparse matrices of the new grid
+                      moves from those positions, one per action
+        @param S: the new stable markov chain
+        """
+        keep = np.ones(self.n_cells)
+        keep[positions] = 0
+        for (a, new) in enumerate(moves):
+            new = new.tocoo()
+            new = sparse.csr_matrix((new.data, (positions[new.row], new.col)),
+                                    shape=(self.n_cells, self.n_cells))
+            self.moves[a] = (sparse.diags(keep).dot(self.moves[a]) + new).tocsr()
+            self.moves[a].eliminate_zeros()
+        self.S = sparse.csr_matrix(S, dtype=np.float64)
+
+class MapOperator(object):
+    """
+    Matrix-free transition model T(s, a, s') of the dungeon.
+
+    Nothing of size N x N is stored: the expected values Σ T(s, a, s') V(s')
+    are computed on the fly from the map, in vectorized sweeps over the
+    positions, for all the combinations of items at once:
+        - entering the cells: every effect of the lookup table of the cells
+          (see Dungeon.cell_outcomes) only permutes the blocks of items
+        - moving on the grid: the table of the next positions, and the sparse
+          teleport distributions (see Dungeon.make_sparse_teleports)
+    The memory needed is O(N), for maps too large for any explicit model.
+    """
+
+    def __init__(self, grid: np.array, moves: np.array, outcomes: dict, teleports: tuple):
+        """
+        @param grid: array of the n * m cells of the map
+        @param moves: array 4 x (n * m) of the positions reached by each move
+                      (see DungeonMap.next_positions)
+        @param outcomes: lookup table of the cells (see Dungeon.cell_outcomes)
+        @param teleports: moving, L, c, B_portal (see Dungeon.make_sparse_teleports)
+        """
+        self.grid = grid
+        self.n_cells = len(grid)
+        self.n_states = State.swords * State.treasures * self.n_cells + 1
+        self.n_actions = len(moves)
+        self.moves = moves
+        self.start = self.n_cells - 1
+        # ───────── probability of each effect, without / with sword ───────── #
+        self.effects = {}
+        for (cell, table) in outcomes.items():
+            on_cell = grid == cell
+            for (p, p_sword, effect) in table:
+                P = self.effects.setdefault(effect, np.zeros((2, 1, self.n_cells)))
+                P[:, 0, on_cell] += np.array([p, p_sword])[:, None]
+        # ──────────────────── moves leading to teleport ───────────────────── #
+        moving, self.L, self.c, self.B_portal = teleports
+        self.slot = np.full(self.n_cells, -1)
+        self.slot[moving] = np.arange(len(moving))
+        self.teleporting = (self.slot[moves] >= 0) & (moves != np.arange(self.n_cells))
+
+    # ────────────────────────── shape of the model ────────────────────────── #
+    @property
+    def shape(self):
+        return (self.n_states, self.n_actions, self.n_states)
+
+    @property
+    def nnz(self):
+        """ number of probabilities stored (the teleportations) """
+        return self.L.nnz + len(self.c) + self.n_cells
+
+    # ─────────────────────────── matrix products ──────────────────────────── #
+    def enter(self, V: np.array):
+        """
+        @param V: array of N values, one for each state
+        @return array 6 x (n * m): the expected value of entering each cell,
+                for each combination of items
+        """
+        E = self.effects.get
+        zero = np.zeros((2, 1, self.n_cells))
+        B = V[:-1].reshape(State.swords, State.treasures, self.n_cells)
+        W = E('stay', zero) * B
+        W += E('start', zero) * B[:, :, self.start, None]
+        W += E('death', zero) * V[-1]
+        W += E('sword', zero) * B[1]
+        W += E('key', zero) * B[:, [1, 1, 2]]
+        # the treasure can only be picked up with the key
+        W += E('treasure', zero) * B[:, [0, 2, 2]]
+        return W.reshape(-1, self.n_cells)
+
+    def dot(self, V: np.array):
+        """
+        @param V: array of N values, one for each state
+        @return array N x 4: the expected value of the next state, Σ T(s, a, s') V(s')
+        """
+        W = self.enter(V)
+        # value of entering each moving cell, from its teleport distribution
+        W_tele = self.L.dot(W.T) + np.outer(self.c, W.dot(self.B_portal))
+        Q = np.zeros((self.n_states, self.n_actions), np.float64)
+        for (a, q) in enumerate(self.moves):
+            Wa = W[:, q]
+            tele = self.teleporting[a]
+            Wa[:, tele] = W_tele[self.slot[q[tele]]].T
+            Q[:-1, a] = Wa.ravel() # death stays at 0
+        return Q
+
+    def policy(self, P: np.array):
+        """
+        @param P: array of N actions, one for each state
+        @return LinearOperator N x N: the transitions when following the policy P
+        """
+        states = np.arange(self.n_states)
+        return LinearOperator((self.n_states, self.n_states), dtype=np.float64,
+                              matvec=lambda V: self.dot(np.ravel(V))[states, P])
+
+    # ────────────────────── access to the transitions ─────────────────────── #
+    def certain(self, states: np.array= None):
+        """
+        Finds the 'certain' transitions, the state-actions leading to a single
+        state with probability 1 (a teleportation mixing portals with other
+        cells is never considered certain)
+
+        @param states: array of k states to consider (every state if None)
+        @return certain, target: two arrays of k x 4
+                    - certain: True if (s, a) leads to a single state
+                    - target: that state, when certain
+        """
+        n_cells, death = self.n_cells, self.n_states - 1
+        states = np.arange(self.n_states) if states is None else np.asarray(states)
+        living = states < death
+        b, p = np.divmod(np.where(living, states, 0), n_cells)
+        sw, tr = np.divmod(b, State.treasures)
+        # ────────────── single cell reached by a teleportation ────────────── #
+        L = self.L.tocsr()
+        single = (np.diff(L.indptr) == 1) & (self.c == 0)
+        landing = np.zeros(len(self.c), np.int64)
+        landing[single] = L.indices[L.indptr[:-1][single]]
+        single &= L.max(axis=1).toarray().ravel() == 1
+        if self.B_portal.max() == 1:
+            portal = (self.c == 1) & (np.diff(L.indptr) == 0)
+            single |= portal
+            landing[portal] = self.B_portal.argmax()
+        # ─────────────── certain effect of entering the cell ──────────────── #
+        names = sorted(self.effects)
+        P = np.stack([self.effects[e][:, 0] for e in names]) # effects x 2 x (n * m)
+        effect_id = {
+            'stay':     lambda q: b * n_cells + q,
+            'start':    lambda q: b * n_cells + self.start,
+            'death':    lambda q: np.full(len(q), death),
+            'sword':    lambda q: (State.treasures + tr) * n_cells + q,
+            'key':      lambda q: (sw * State.treasures + np.maximum(tr, 1)) * n_cells + q,
+            'treasure': lambda q: (sw * State.treasures + np.where(tr >= 1, 2, 0)) * n_cells + q,
+        }
+        dies = self.dot((np.arange(self.n_states) == death).astype(np.float64))[states] == 1
+        certain = np.zeros((len(states), self.n_actions), bool)
+        target = np.full((len(states), self.n_actions), death)
+        for (a, moves) in enumerate(self.moves):
+            q = moves[p]
+            tele = self.teleporting[a, p]
+            reached = ~tele | single[np.maximum(self.slot[q], 0)]
+            q = np.where(tele, landing[np.maximum(self.slot[q], 0)], q)
+            probs = P[:, sw, q] # effects x k
+            sure = reached & living & (probs.max(axis=0) == 1)
+            effect = probs.argmax(axis=0)
+            for (e, name) in enumerate(names):
+                on = sure & (effect == e)
+                target[on, a] = effect_id[name](q)[on]
+            certain[:, a] = sure | (living & dies[:, a])
+        return certain, target
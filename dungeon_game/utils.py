@@ -147,7 +147,7 @@ def color_grid(array, size:int, cell_size: int=3, border_colors: dict= None,
             content = array[i * m + j].center(cell_size, ' ')
             all_cells[2*i+1][2*j+1] = content if color is None else add_color(content, color)
 
-            # --------------- doing the right if last column ----------------- #
+            # ---------------- doing the right if last column ---------------- #
             if j == m - 1:
                 # right side
                 color = cell_color(i, j + 1, 'col')
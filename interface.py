@@ -2,6 +2,7 @@
 # ───────────────────────────────── imports ────────────────────────────────── #
 from dungeon_game.kernel import Dungeon, Direction
 from dungeon_game.dungeon_map import Cell
+from dungeon_game.events import EventBuffer, render
 from dungeon_game.utils import add_sword
 from time import sleep
 from tkinter.font import Font
@@ -15,6 +16,7 @@ class TextInterface(object):
         self.dungeon = dungeon
         assert len(dungeon.agents) == 1, "currently designed for 1 adventurer"
         self.player, = dungeon.agents
+        dungeon.events = EventBuffer() # captions are only rendered here
 
     # ──────────────────── play a game with an Adventurer ──────────────────── #
     def play_game(self, time_step_ms: int= 500):
@@ -58,8 +60,12 @@ class TextInterface(object):
         print('-' * (1 + self.dungeon.m * 4))
         print(add_sword(self.infos, Cell.pretty_cells))
         print('-' * (1 + self.dungeon.m * 4))
-        print(self.dungeon.caption)
-        self.dungeon.caption = ''
+        print(self.caption)
+
+    @property
+    def caption(self):
+        """ caption of the events since the last display """
+        return render(self.dungeon.events.drain())
 
     @property
     def infos(self):
@@ -102,8 +108,7 @@ class LearningInterface(TextInterface):
         print('-' * (1 + self.dungeon.m * 4))
         print(add_sword(self.infos, Cell.pretty_cells))
         print('-' * (1 + self.dungeon.m * 4))
-        print(self.dungeon.caption)
-        self.dungeon.caption = ''
+        print(self.caption)
 
 # ─────────────────────────── graphical interface ──────────────────────────── #
 class GraphicalInterface(TextInterface, tk.Tk):
@@ -184,15 +189,12 @@ class GraphicalInterface(TextInterface, tk.Tk):
         actions     = self.dungeon.show_last_actions()
         infos       = add_sword(self.infos, Cell.pretty_cells)
         # caption     = '-' * (1 + self.dungeon.m * 4) + '\n' + self.dungeon.caption
-        caption     = self.dungeon.caption
+        caption     = self.caption
 
         self.message_actions.configure(text=actions)
         self.message_infos.configure(text=infos)
         self.message_caption.configure(text=caption)
 
-        # ------------------------- reseting caption ------------------------- #
-        self.dungeon.caption = ''
-
     # ────────────────────────── handling keypress ─────────────────────────── #
     def on_keypress(self, event):
         if not self.dungeon.over:
@@ -5,24 +5,22 @@ from interface import TextInterface, GraphicalInterface
 from dungeon_game.characters import *
 from dungeon_game.mdp import *
 from dungeon_game.kernel import Dungeon
+from dungeon_game.cache import ModelCache
+from dungeon_game.batch import BatchDungeon
+from dungeon_game.evaluation import evaluate
+from dungeon_game.sweep import ParameterSweep
+from dungeon_game.analysis import PolicyAnalysis
 import sys ,argparse, textwrap
 # ──────────────────────────────────────────────────────────────────────────── #
 
-def test_agent(dungeon: Dungeon, iterations: int= 500):
-    """ tests an agent over a few hundred iterations, returns the stats """
-    assert len(dungeon.agents) == 1
-    agent, = dungeon.agents
-    wins, looses = 0, 0
-    for i in range(iterations):
-        dungeon.replay_map()
-        while not dungeon.over:
-            action = agent.play(agent.state)
-            dungeon.move(agent, action)
-        if dungeon.won:
-            wins += 1
-        else:
-            looses += 1
-    return wins, looses
+def test_agent(dungeon: Dungeon, iterations: int= 500, jobs: int= 1, seed: int= None):
+    """
+    tests an agent over a few hundred iterations, returns the stats
+    (wins, looses, average length of the games), see evaluate. the games
+    still running after 10000 steps are lost
+    """
+    wins, steps = evaluate(dungeon, iterations, jobs, seed)
+    return int(wins.sum()), int((~wins).sum()), steps.mean()
 
 def setup_parser():
     """ configures the parser with every optionnal arguments needed """
@@ -44,6 +42,10 @@ def setup_parser():
                           algorithm
                         - MDP policy computed using the policy iteration
                           algorithm
+                        - MDP policy computed using the modified policy
+                          iteration algorithm (partial evaluations)
+                    - study the MDP policy over many settings of the enemies
+                      and discount factor (parameter sweep)
                     - load a map from a txt (using our special format)
                     - save a map to a txt
                     - generate a random map
@@ -56,6 +58,9 @@ def setup_parser():
                 >> main -p value-mdp -g -r 10 -c 10 --automatic
                 watch step by step the qlearning policy on a specific map
                 >> main -l maps/default_map.txt -p qlearning
+                sweep the enemy probability and discount factor of a map
+                >> main -l maps/map_long.txt -p value-mdp --sweep sweep.csv \\
+                       --sweep-enemy 0.3 0.5 0.7 --sweep-gamma 0.9 0.95
                 '''))
 
     game_modes = parser.add_mutually_exclusive_group()
@@ -108,6 +113,14 @@ def setup_parser():
             Number of games to test the agent's performance
             """ + default))
 
+    parser.add_argument("--exact", action="store_true",
+            dest='exact', default=False,
+    help=textwrap.dedent("""\
+            computes the win probability and the expected length of the
+            games of the policy from the model (absorbing markov chain),
+            instead of playing games (--test, qlearning evaluation)
+            """) + default)
+
     # Value of the iteration for Qlearning
     timestep.add_argument("--iteration", metavar="iteration",
                           dest='iteration', type=int, default=5000,
@@ -122,8 +135,46 @@ def setup_parser():
                     load an existing Qtable (Warning : must be for a spécified map)
                     """ + default))
 
+    # Directory of the model cache
+    parser.add_argument("--cache-dir", metavar="cache-dir",
+            dest='cache_dir', type=str, default=None,
+    help=textwrap.dedent("""\
+            directory where the transition and reward models of the MDP
+            agents are cached between runs [default: ~/.cache/dungeon_game]
+            """))
+
+    # Parallel evaluation
+    parser.add_argument("--jobs", metavar="jobs",
+            dest='jobs', type=int, default=1,
+    help=textwrap.dedent("""\
+            number of processes playing the games of --test
+            """) + default)
+
+    parser.add_argument("--seed", metavar="seed",
+            dest='seed', type=int, default=None,
+    help=textwrap.dedent("""\
+            seed of the games of --test, the results only depend on the
+            seed and the number of jobs [default: random]
+            """))
+
+    # Sweeps of the value iteration
+    solvers = ('jacobi', 'gauss-seidel', 'async', 'prioritized', 'phases')
+    parser.add_argument("--solver", metavar="solver",
+            dest='solver', type=str, choices=solvers, default='jacobi',
+    help=textwrap.dedent("""\
+            sweeps of the value iteration of the MDP agents :
+            {}
+            """.format('\n'.join(['- ' + s for s in solvers]))) + default)
+
+    # Partial evaluations of the modified policy iteration
+    parser.add_argument("--evaluation-steps", metavar="k",
+            dest='evaluation_steps', type=int, default=MDP.evaluation_steps,
+    help=textwrap.dedent("""\
+            maximum sweeps of each policy evaluation of modified-policy-mdp
+            """) + default)
+
     # Play an given policy
-    valid_agents= ('value-mdp', 'policy-mdp', 'qlearning', 'random')
+    valid_agents= ('value-mdp', 'policy-mdp', 'modified-policy-mdp', 'qlearning', 'random')
     game_modes.add_argument("-p", "--policy", metavar="policy", dest='policy',
             type=str, choices=valid_agents,
     help=textwrap.dedent("""\
@@ -157,6 +208,27 @@ def setup_parser():
             prints some stats about its winrate in the current environment.
             """) + default)
 
+    # Parameter sweep of an MDP policy
+    inter.add_argument("--sweep", metavar="table-path",
+            dest="sweep", type=str, default='',
+            help=textwrap.dedent("""\
+            solves the MDP policy for every setting of --sweep-enemy and
+            --sweep-gamma, and writes a csv table of the values, win
+            probabilities and policies of the settings
+            """))
+
+    parser.add_argument("--sweep-enemy", metavar="p", nargs='+',
+            dest='sweep_enemy', type=float, default=[0.1, 0.3, 0.5, 0.7, 0.9],
+    help=textwrap.dedent("""\
+            probabilities to win against an enemy of --sweep
+            """) + default)
+
+    parser.add_argument("--sweep-gamma", metavar="gamma", nargs='+',
+            dest='sweep_gamma', type=float, default=[0.9],
+    help=textwrap.dedent("""\
+            discount factors of --sweep
+            """) + default)
+
     # Watch a policy step by step
     inter.add_argument("--step-by-step", action="store_true",
             dest="steps", default=False,
@@ -189,6 +261,14 @@ def setup_parser():
                 """) + default)
 
 
+    # Do not use the model cache
+    parser.add_argument("--no-cache", action="store_false",
+            dest="cache", default=True,
+            help=textwrap.dedent("""\
+            always build the models of the MDP agents, without reading or
+            writing the model cache
+            """))
+
     # Use a text interface instead of graphical
     parser.add_argument("-t", "--text-interface", action="store_true",
             dest="text_interface", default=False,
@@ -214,6 +294,7 @@ if __name__ == '__main__':
     advClass = Adventurer
     if args.policy:
         advClass = { 'value-mdp': ValueMDP, 'policy-mdp': PolicyMDP,
+                'modified-policy-mdp': ModifiedPolicyMDP,
                 'qlearning': AdventurerLearning, 'random': RandomAdventurer}[args.policy]
 
     # ────────────────────────── create the dungeon ────────────────────────── #
@@ -223,6 +304,10 @@ if __name__ == '__main__':
         exit(0)
 
     Dungeon.p_enemy = args.enemy_p
+    MDP.solver = args.solver
+    MDP.evaluation_steps = args.evaluation_steps
+    if args.cache:
+        Dungeon.model_cache = ModelCache(args.cache_dir)
     dungeon = Dungeon(args.r, args.c, 1, [advClass], args.new_env)
 
     # ────────────────────────────── load a map ────────────────────────────── #
@@ -255,11 +340,10 @@ if __name__ == '__main__':
                 t = 0
                 while not dungeon.over and t <= 2000:
                     t +=1
-                    dungeon.caption = ''
-                    old_state = player.state
+                    old_state = player.compact_id
                     action = player.policy()
                     reward = dungeon.move(player, action)
-                    new_state = player.state
+                    new_state = player.compact_id
                     player.process_reward(old_state, new_state, action, reward)
                 if i % 100 == 0:
                     print(i)
@@ -267,22 +351,12 @@ if __name__ == '__main__':
         q_table = player.Q
         dungeon.reset()
         player.load_Qtable(q_table)
-        a = []
-        t = 0
-        while len(a) < 100 and t < 10000:
-            t += 1
-            k = 0
-            q_table = player.Q
-            dungeon.reset()
-            player.load_Qtable(q_table)
-            while not dungeon.over and k <= 2000:
-                dungeon.caption = ''
-                action = player.policy()
-                dungeon.move(player, action)
-                k += 1
-            if player.alive and k < 2000:
-                a.append(k)
-        ratio = len(a) / t
+        if args.exact:
+            won, dead = PolicyAnalysis.of(player).steps_distribution(2000)
+            ratio = won[:2000].sum() # won in less than 2000 steps
+        else:
+            wins, steps = BatchDungeon(dungeon, 1000).run(player.play_batch, 2000)
+            ratio = np.mean(wins & (steps < 2000))
         print("% victory : ", round((ratio*100), 2), "%")
 
 
@@ -299,11 +373,26 @@ if __name__ == '__main__':
     # ───────────────────────── select the game-type ───────────────────────── #
     if args.interactive:
         interface.loop()
+    elif args.test and args.exact:
+        analysis = PolicyAnalysis.of(dungeon.agents[0])
+        print("{} wins with probability {:4.2%}, dies with probability {:4.2%} "
+              "({:.2f} steps per game)".format(args.policy, analysis.win,
+              analysis.death, analysis.expected_steps))
     elif args.test:
-        w, l = test_agent(dungeon, args.test_iter)
+        w, l, length = test_agent(dungeon, args.test_iter, args.jobs, args.seed)
         winrate = w / (w + l)
-        print("{} won {:4.2%} of the games over {} iterations".format(
-            args.policy, winrate, args.test_iter))
+        print("{} won {:4.2%} of the games over {} iterations ({:.2f} steps per game)".format(
+            args.policy, winrate, args.test_iter, length))
+    elif args.sweep:
+        if not isinstance(dungeon.agents[0], MDP):
+            print("A parameter sweep needs an MDP policy [-p value-mdp].")
+            exit(0)
+        sweep = ParameterSweep(dungeon)
+        results = sweep.run(args.sweep_enemy, args.sweep_gamma, args.jobs)
+        ParameterSweep.write_table(results, args.sweep)
+        for r in results:
+            print("p_enemy {p_enemy:.2f}, gamma {gamma:.3f}: value {value:.3f}, "
+                  "wins {win:6.2%} ({iterations} iterations)".format(**r))
     elif args.steps:
         interface.play_game_step()
     elif args.automatic:
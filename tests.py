@@ -2,6 +2,7 @@
 # encoding: utf-8
 # ───────────────────────────────── imports ────────────────────────────────── #
 import pytest, numpy as np
+from pytest import approx
 from dungeon_game.states import State
 from dungeon_game.dungeon_map import Direction, Cell
 from dungeon_game.mdp import *
@@ -63,6 +64,11 @@ def test_move():
     assert agent.pos == (0, 1)
     d.move(agent, Direction.WEST)
     assert agent.pos == (0, 0)
+    # the last action of every agent, one added after the others
+    other = Adventurer(d)
+    d.add_agent(other)
+    d.move(other, Direction.NORTH)
+    assert d.last_actions == [Direction.WEST, Direction.NORTH]
 
 def test_win():
     d = Dungeon(2, 2, 1)
@@ -75,6 +81,49 @@ def test_win():
     d.move(a, Direction.EAST)
     assert d.over == True
 
+def test_step():
+    d = Dungeon(2, 2, 1, [Adventurer])
+    d.map.load_as_main([t, k, s, b])
+    d.reset()
+    agent, = d.agents
+    N, E, S, W = range(4)
+    state = agent.s_id
+    for action in (W, N, E, W, S, E):
+        reward = d.move(agent, Direction.from_int(action))
+        state, r, done = d.step(state, action)
+        assert (state, r, done) == (agent.s_id, reward, d.over)
+    # the steps follow the transition model
+    d = Dungeon(8, 8, 0)
+    d.load_map('maps/custom_map.txt')
+    T = d.make_transition_matrix()
+    states = d.state_index.states[:-1]
+    for state in np.random.choice(states, 10):
+        action = np.random.randint(4)
+        counts = np.zeros(State.max_id + 1)
+        for _ in range(2000):
+            counts[d.step(int(state), action)[0]] += 1
+        assert counts / 2000 == approx(T.rows(action, [state]).toarray()[0], abs=0.05)
+
+def test_events():
+    from dungeon_game.events import Event, EventBuffer, render
+    d = Dungeon(2, 2, 1, [Adventurer])
+    d.map.load_as_main([t, k, s, b])
+    d.reset()
+    a, = d.agents
+    assert d.events is None # headless by default
+    d.move(a, Direction.WEST)
+    d.events = EventBuffer(4)
+    for direction in (Direction.NORTH, Direction.EAST, Direction.WEST, Direction.SOUTH):
+        d.move(a, direction)
+    assert render(d.events.drain()) == "Picked up an item (golden_key) !!" \
+        "Got the treasure !Can't pick up another magic_sword, already have one"
+    assert len(d.events) == 0
+    for _ in range(5):
+        d.move(a, Direction.SOUTH) # stays on the sword
+    d.move(a, Direction.EAST)
+    # only the last 4 events are kept
+    assert d.events.drain() == [(Event.item_held, (1,))] * 3 + [(Event.victory, ())]
+
 def test_transition_portals():
     print('\n' + '=' * 80)
     custom_game = Dungeon(4, 4)
@@ -125,6 +174,571 @@ def test_tansition_platforms():
     print("Middle bottom, going up to a platform")
     custom_game.display_transition(State(1, 1, 10), Direction.NORTH)
 
+def test_teleport_distributions():
+    d = Dungeon(4, 4, 0)
+    d.map.load_as_main([t, p, p, s,
+                        p, p, m, p,
+                        m, p, m, m,
+                        k, m, p, b])
+    d.reset()
+    M = d.moving_markov_chain()
+    D = d.make_teleport_distributions(M)
+    assert sorted(D) == [1, 2, 4, 5, 6, 7, 8, 9, 10, 11, 13, 14]
+    for (h, distrib) in D.items():
+        mu = np.zeros(16)
+        mu[h] = 1
+        assert distrib == approx(M.iterate(mu, 1000))
+        assert distrib.sum() == approx(1) and (distrib[list(D)] == 0).all()
+
+def test_teleport_closed_platforms():
+    w = Cell.wall
+    d = Dungeon(4, 4, 0)
+    d.map.load_as_main([t, e, e, k,
+                        w, w, w, e,
+                        m, m, w, e,
+                        w, w, s, b])
+    d.reset()
+    D = d.make_teleport_distributions(d.moving_markov_chain())
+    # platforms only leading to each other: the adventurer stays on them
+    assert D[8][8] == D[9][9] == 1
+
+def test_teleport_walled_platform():
+    w = Cell.wall
+    d = Dungeon(4, 4, 1, [ValueMDP])
+    d.map.load_as_main([t, e, e, k,
+                        w, w, e, e,
+                        m, w, e, e,
+                        w, s, e, b])
+    d.reset()
+    # a platform surrounded by walls keeps the adventurer on it
+    D = d.make_teleport_distributions(d.moving_markov_chain())
+    assert D[8][8] == 1
+    assert 8 not in d.make_sparse_teleports()[0]
+    # and the models are built (the agent solved them)
+    for M in d.make_transition_matrix().expand().matrices:
+        assert np.allclose(M.sum(axis=1)[:-1], 1)
+    assert d.agents[0].ready
+
+def test_transition_sparse():
+    d = Dungeon(12, 12, 0)
+    T = d.make_transition_matrix().expand()
+    n_states, death = State.max_id + 1, State.max_id
+    assert T.shape == (n_states, 4, n_states)
+    for Ta in T.matrices:
+        sums = np.asarray(Ta.sum(axis=1)).ravel()
+        assert np.allclose(sums[:death], 1) and sums[death] == 0
+    # only a handful of next states, except when moving into a portal
+    portals = [h for h in range(12 * 12) if d.map[h] == Cell.magic_portal]
+    assert T.nnz <= 4 * 3 * n_states + 4 * 6 * 3 * len(portals) * 12 * 12
+
+def test_transition_factored():
+    d = Dungeon(8, 8, 0)
+    T = d.make_transition_matrix()
+    flat = T.expand()
+    assert T.nnz < flat.nnz
+    V = np.random.random(State.max_id + 1)
+    assert np.allclose(T.dot(V), flat.dot(V))
+    P = np.random.randint(4, size=State.max_id + 1)
+    assert abs(T.policy(P) - flat.policy(P)).max() < 1e-12
+    states = np.random.choice(State.max_id + 1, 50)
+    (certain, target), (flat_certain, flat_target) = T.certain(states), flat.certain(states)
+    assert (certain == flat_certain).all()
+    assert (target[certain] == flat_target[certain]).all()
+    s = states[0]
+    assert (T[s, 1] == flat[s, 1]).all()
+
+def test_markov_chains():
+    d = Dungeon(2, 4, 0)
+    d.map.load_as_main([t, Cell.enemy_special, m, k,
+                        Cell.enemy_normal, p, s, b])
+    d.reset()
+    S, M = d.markov_chain(), d.moving_markov_chain()
+    death = State.max_id
+    assert np.allclose(S.sum(axis=1), 1) and np.allclose(M.sum(axis=1), 1)
+    # the special enemy is only dangerous for the adventurer with a sword
+    assert S[State(0, 0, 1).id, State(0, 0, 1).id] == 1
+    assert S[State(1, 0, 1).id, death] == Dungeon.p_enemy
+    assert S[State(0, 0, 4).id, death] == approx(1 - Dungeon.p_enemy)
+    assert S[State(1, 0, 4).id, State(1, 0, 4).id] == 1
+    # a platform moves to adjacent cells, a portal anywhere
+    assert M[2, 1] == M[2, 3] == M[2, 6] == approx(1 / 3)
+    assert (M[5] == 1 / 8).all()
+
+def test_reward_matrix():
+    d = Dungeon(2, 2, 0)
+    d.map.load_as_main([t, k, s, b])
+    d.reset()
+    R = d.make_reward_matrix(d.make_transition_matrix())
+    N, E, S, W = [a.to_int for a in Direction]
+    assert R[State(0, 0, 3).id, N] == 0.5 # picking up the key
+    assert R[State(0, 0, 3).id, W] == 0.5 # picking up the sword
+    assert R[State(1, 1, 1).id, W] == 0.5 # picking up the treasure
+    assert R[State(1, 2, 1).id, W] == 0   # treasure already taken
+    assert R[State(1, 2, 3).id, E] == 1   # back to start with the treasure
+    assert R[State(0, 1, 3).id, N] == 0   # key already taken
+    assert (R[State.max_id] == 0).all()
+
+def test_incremental_update():
+    d = Dungeon(3, 6, 1, [ValueMDP])
+    w = Cell.wall
+    d.map.load_as_main([t, s, p, m, e, k,
+                        e, e, e, p, w, e,
+                        e, w, e, e, e, b])
+    d.reset()
+    agent, = d.agents
+    for (pos, cell) in (((1, 2), Cell.enemy_normal), ((2, 3), m), ((1, 4), e)):
+        d.map[pos] = cell
+        d.reset()
+        T = d.make_transition_matrix()
+        model_T, model_R = agent.model
+        for (Ta, Tb) in zip(model_T.expand().matrices, T.expand().matrices):
+            assert abs(Ta - Tb).max() < 1e-12
+        assert (model_R == d.make_reward_matrix(T)).all()
+        V, P = agent.value_iteration()
+        assert np.abs(agent.V - V).max() < 2 * agent.epsilon / (1 - agent.gamma)
+
+def test_incremental_reshape(tmp_path):
+    # the same cells laid out as 6 x 3: the model is rebuilt, not patched
+    d = Dungeon(3, 6, 1, [ValueMDP])
+    d.load_map('maps/map_short.txt')
+    with open('maps/map_short.txt') as f:
+        cells = f.read().splitlines()[1]
+    (tmp_path / 'reshaped.txt').write_text('6,3\n' + cells)
+    d.load_map(str(tmp_path / 'reshaped.txt'))
+    agent, = d.agents
+    T = d.make_transition_matrix()
+    for (Ta, Tb) in zip(agent.model[0].expand().matrices, T.expand().matrices):
+        assert abs(Ta - Tb).max() < 1e-12
+
+def test_sparse_teleports():
+    for grid in ([t, p, p, s, p, p, m, p, m, p, m, m, k, m, p, b],
+                 [t, e, e, k, Cell.wall, Cell.wall, Cell.wall, e,
+                  m, m, Cell.wall, p, Cell.wall, Cell.wall, s, b]):
+        d = Dungeon(4, 4, 0)
+        d.map.load_as_main(grid)
+        d.reset()
+        D = d.make_teleport_distributions(d.moving_markov_chain())
+        moving, L, c, B_portal = d.make_sparse_teleports()
+        assert len(moving) == L.shape[0] <= len(D)
+        for (h, q) in enumerate(moving):
+            assert L[h].toarray().ravel() + c[h] * B_portal == approx(D[q])
+
+def test_matrix_free():
+    d = Dungeon(3, 6, 1, [ValueMDP])
+    d.map.load_as_main([t, s, p, m, e, k,
+                        e, e, e, p, Cell.wall, Cell.trap,
+                        e, Cell.wall, Cell.enemy_special, e, Cell.crack, b])
+    d.reset()
+    T, O = d.make_transition_matrix(), d.make_operator()
+    V = np.random.random(State.max_id + 1)
+    assert np.allclose(T.dot(V), O.dot(V))
+    assert (d.make_reward_matrix(T) == d.make_reward_matrix(O)).all()
+    agent, = d.agents
+    V, reachable = agent.index.scatter(agent.V), agent.index.states
+    MDP.matrix_free = True
+    try:
+        d.reset()
+    finally:
+        MDP.matrix_free = False
+    assert len(agent.V) == State.max_id + 1
+    eps = 2 * agent.epsilon / (1 - agent.gamma)
+    assert np.abs(agent.V[reachable] - V[reachable]).max() < eps
+
+def test_matrix_free_no_model(monkeypatch):
+    # neither the explicit model nor the dense moving chain is ever built
+    def explicit(self, *args):
+        raise AssertionError("explicit model built")
+    for method in ('make_model', 'make_transition_matrix', 'moving_markov_chain'):
+        monkeypatch.setattr(Dungeon, method, explicit)
+    monkeypatch.setattr(MDP, 'matrix_free', True)
+    d = Dungeon(8, 16, 1, [ValueMDP])
+    d.load_map('maps/map_long.txt')
+    agent, = d.agents
+    assert len(agent.V) == d.space.n_states
+    for _ in range(20):
+        d.move(agent, agent.play(agent.state))
+    agent.play_batch(np.arange(10))
+
+def test_state_index():
+    d = Dungeon(4, 4, 0)
+    w, c = Cell.wall, Cell.crack
+    d.map.load_as_main([t, c, k, w,
+                        w, w, e, w,
+                        m, p, e, s,
+                        w, w, e, b])
+    d.reset()
+    T, R = d.make_model()
+    index = d.state_index
+    assert index.states[-1] == State.max_id # death is always indexed
+    assert (index.complete(index.compact(index.states)) == index.states).all()
+    for cell in (3, 4, 5, 7, 12, 13): # walls
+        assert (index.compact(State(0, 0, cell).id) == -1)
+    assert index.compact(State(0, 0, 1).id) == -1 # crack
+    assert index.compact(State(1, 2, 15).id) >= 0 # back to start
+    assert index.compact(State(0, 0, 9).id) == -1 # portal
+    assert index.compact(State(0, 1, 0).id) == -1 # the treasure is taken
+    # no probability is lost by restricting the model to the reachable states
+    Tc = T.restrict(index)
+    sums = np.asarray(Tc.matrices[0].sum(axis=1)).ravel()
+    assert np.allclose(sums[:-1], 1) and len(sums) == len(index) < State.max_id / 2
+    # kept while the layout doesn't change, the operator leaving it alone
+    d.reset()
+    d.make_operator()
+    assert d.state_index is index
+    d.map[1, 3] = e
+    assert d.state_index is not index and d.state_index.compact(State(0, 0, 7).id) >= 0
+
+def test_state_spaces():
+    from dungeon_game.states import StateSpace
+    from threading import Thread
+    space = StateSpace(3, 6)
+    state = space.state(1, 2, 7)
+    assert (state.sword, state.treasure, state.i, state.j) == (1, 2, 1, 1)
+    assert space.id_to_state(state.id) == (1, 2, 7)
+    assert [x.tolist() for x in space.decode([state.id])] == [[1], [2], [7]]
+    # dungeons of different sizes don't share their ids
+    small = Dungeon(3, 6, 1, [ValueMDP])
+    small.load_map('maps/map_short.txt')
+    V = small.agents[0].V.copy()
+    large = Dungeon(8, 16, 1, [ValueMDP])
+    large.load_map('maps/map_long.txt')
+    assert State.max_id == large.space.max_id # the default space is the last one
+    agent, = small.agents
+    assert agent.state.i == 2 and agent.state.j == 5
+    assert small.step(small.space.start, Direction.WEST.to_int)[0] == small.space.start - 1
+    results = {}
+    def solve(d):
+        for _ in range(3):
+            d.agents[0].model = None, None # rebuilt from scratch
+            d.agents[0].reset()
+            results[d] = d.agents[0].V.copy()
+    threads = [Thread(target=solve, args=(d,)) for d in (small, large)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert results[small] == approx(V, abs=2 * agent.epsilon / (1 - agent.gamma)) # warm starts
+    assert len(results[large]) == len(large.state_index)
+
+def test_compact_mdp():
+    d = Dungeon(3, 6, 1, [ValueMDP])
+    w = Cell.wall
+    d.map.load_as_main([t, s, p, m, e, k,
+                        e, e, e, p, w, e,
+                        e, w, e, e, e, b])
+    d.reset()
+    agent, = d.agents
+    V = agent.index.scatter(agent.V)
+    MDP.compact = False
+    try:
+        d.reset()
+    finally:
+        MDP.compact = True
+    assert len(agent.V) == State.max_id + 1
+    reachable = d.state_index.states
+    eps = 2 * agent.epsilon / (1 - agent.gamma)
+    assert np.abs(agent.V[reachable] - V[reachable]).max() < eps
+    # the actions played are the ones of the policy, on complete ids
+    played = [agent.play(State(s_id=s, space=d.space)).to_int for s in reachable]
+    assert played == list(agent.P[reachable])
+    assert (agent.play_batch(reachable) == agent.P[reachable]).all()
+
+def test_gauss_seidel():
+    d = Dungeon(8, 16, 1, [ValueMDP])
+    d.load_map('maps/map_long.txt')
+    agent, = d.agents
+    V, _ = agent.value_iteration()
+    jacobi = agent.iterations
+    eps = 2 * agent.epsilon / (1 - agent.gamma)
+    for solver in ('gauss-seidel', 'async'):
+        agent.solver = solver
+        W, P = agent.value_iteration()
+        assert np.abs(W - V).max() < eps
+        assert agent.iterations < jacobi / 2
+    layers = agent.backward_layers()
+    assert sorted(np.concatenate(layers)) == list(range(len(agent.R)))
+    assert (agent.R[layers[0]].max(axis=1) > 0).all()
+
+def test_prioritized_sweeping():
+    d = Dungeon(8, 16, 1, [ValueMDP])
+    d.load_map('maps/map_long.txt')
+    agent, = d.agents
+    V, P = agent.value_iteration()
+    jacobi = agent.iterations * len(V) # backups of the full sweeps
+    agent.solver = 'prioritized'
+    W, Q = agent.value_iteration()
+    assert np.abs(W - V).max() < 2 * agent.epsilon / (1 - agent.gamma)
+    assert agent.backups < jacobi / 2
+    # the priorities bound the bellman errors: every one is below epsilon
+    error = np.abs((agent.R + agent.gamma * agent.T.dot(W)).max(axis=1) - W)
+    assert error.max() < agent.epsilon
+
+def test_phase_decomposition():
+    d = Dungeon(8, 16, 1, [ValueMDP])
+    d.load_map('maps/map_long.txt')
+    agent, = d.agents
+    V, P = agent.value_iteration()
+    jacobi = agent.iterations * len(V) # backups of the full sweeps
+    phases = agent.item_phases()
+    assert sorted(np.concatenate(phases)) == list(range(len(V)))
+    assert len(phases) == 7 and (agent.R[phases[0]] == 0).all() # death first
+    agent.solver = 'phases'
+    W, Q = agent.value_iteration()
+    assert np.abs(W - V).max() < 2 * agent.epsilon / (1 - agent.gamma)
+    assert agent.backups < jacobi / 2
+    # no phases (an item can be lost): back to the jacobi sweeps
+    agent.item_phases = lambda: None
+    W, Q = agent.value_iteration()
+    assert agent.iterations * len(V) == jacobi and (W == V).all()
+
+def test_policy_iteration():
+    from scipy.sparse.linalg import spsolve
+    from scipy import sparse
+    d = Dungeon(8, 16, 1, [PolicyMDP])
+    d.load_map('maps/map_long.txt')
+    agent, = d.agents
+    V, P = agent.value_iteration()
+    W, Q = agent.policy_iteration()
+    assert np.abs(W - V).max() < 2 * agent.epsilon / (1 - agent.gamma)
+    # the iterative evaluation is within epsilon of the exact one
+    Ts, Rs = agent.T.policy(Q), agent.R[np.arange(len(Q)), Q]
+    exact = spsolve((sparse.identity(len(Q)) - agent.gamma * Ts).tocsc(), Rs)
+    assert np.abs(agent.evaluate_policy(Q) - exact).max() < agent.epsilon
+    assert np.abs(agent.evaluate_policy(Q, W) - exact).max() < agent.epsilon
+    # the agent solves its model with policy_iteration, from its last values
+    calls = []
+    agent.policy_iteration = lambda V=None: calls.append(V) or (W, Q)
+    d.reset()
+    assert len(calls) == 1 and np.abs(calls[0] - W).max() < agent.epsilon
+
+def test_modified_policy_iteration():
+    d = Dungeon(8, 16, 1, [ModifiedPolicyMDP])
+    d.load_map('maps/map_long.txt')
+    agent, = d.agents
+    V, P = agent.value_iteration()
+    jacobi = agent.iterations
+    eps = 2 * agent.epsilon / (1 - agent.gamma)
+    W, Q = agent.modified_policy_iteration(k=1) # value iteration
+    assert agent.iterations == jacobi and agent.sweeps == 0
+    for k in (5, 20):
+        W, Q = agent.modified_policy_iteration(k=k)
+        assert np.abs(W - V).max() < eps
+        assert agent.iterations < jacobi / 2
+    d.reset() # the agent solves its model with modified_policy_iteration
+    assert np.abs(agent.V - V).max() < eps
+
+def test_parameter_sweep():
+    from dungeon_game.sweep import ParameterSweep
+    d = Dungeon(8, 16, 1, [ValueMDP])
+    d.load_map('maps/map_long.txt')
+    sweep = ParameterSweep(d)
+    # the interpolated transitions are the ones of a fresh model
+    d.p_enemy = 0.3
+    T, R = d.make_model()
+    del d.p_enemy
+    fresh = T.restrict(sweep.index)
+    for (A, B) in zip(fresh.matrices, sweep.transitions(0.3).matrices):
+        assert abs(A - B).max() == approx(0)
+    assert (sweep.index.gather(R) == sweep.R).all()
+    # every setting is solved, in parallel or not
+    results = sweep.run([0.7, 0.3], [0.9, 0.95])
+    assert [(r['p_enemy'], r['gamma']) for r in results] == \
+           [(0.3, 0.9), (0.3, 0.95), (0.7, 0.9), (0.7, 0.95)]
+    assert results[0]['win'] < results[2]['win'] # stronger against enemies
+    agent, = d.agents
+    agent.gamma = 0.95
+    V, P = agent.value_iteration()
+    assert results[3]['V'] == approx(V, abs=2 * agent.epsilon / (1 - agent.gamma))
+    again = sweep.run([0.7, 0.3], [0.9, 0.95], jobs=2)
+    assert [r['value'] for r in again] == approx([r['value'] for r in results], abs=1e-2)
+
+def test_multimap_solver():
+    from dungeon_game.multimap import MultiMapSolver
+    from dungeon_game.dungeon_map import DungeonMap
+    rng = np.random.default_rng(0)
+    maps = []
+    while len(maps) < 5:
+        d_map = DungeonMap(4, 6)
+        d_map.load_as_main(d_map.generate_map(rng))
+        maps.append(d_map)
+    solver = MultiMapSolver(maps)
+    V, P = solver.solve()
+    assert V.shape == P.shape == (5, State.max_id + 1)
+    d = Dungeon(4, 6, 1, [ValueMDP])
+    agent, = d.agents
+    for (h, d_map) in enumerate(maps):
+        d.map.load_as_main(d_map.snapshot())
+        d.reset()
+        assert (solver.indices[h].states == agent.index.states).all()
+        assert V[h] == approx(agent.index.scatter(agent.V), abs=2 * agent.epsilon / (1 - agent.gamma))
+        assert (P[h] >= 0).sum() == len(agent.index)
+
+def test_batch_dungeon():
+    from dungeon_game.batch import BatchDungeon
+    d = Dungeon(2, 2, 1, [Adventurer])
+    d.map.load_as_main([t, k, s, b])
+    d.reset()
+    agent, = d.agents
+    N, E, S, W = [a.to_int for a in Direction]
+    batch = BatchDungeon(d, 3, seed=0)
+    for action in (W, N, E, W, S, E):
+        reward = d.move(agent, Direction.from_int(action))
+        assert (batch.step(np.full(3, action)) == reward).all()
+        assert (batch.states == agent.state.id).all()
+    assert d.won and batch.won.all() and (batch.steps == 6).all()
+    # fights are won with probability p_enemy
+    d.map.load_as_main([Cell.enemy_normal, k, t, b])
+    batch = BatchDungeon(d, 20000, seed=0)
+    batch.step(np.full(20000, N))
+    batch.step(np.full(20000, W))
+    assert (~batch.alive).mean() == approx(1 - d.p_enemy, abs=0.02)
+
+def test_vec_env():
+    from dungeon_game.env import VecDungeonEnv
+    d = Dungeon(2, 2, 0)
+    d.map.load_as_main([t, k, s, b])
+    env = VecDungeonEnv(3, dungeon=d, seed=0, max_steps=10)
+    start = env.reset()
+    N, E, S, W = range(4)
+    for action in (W, N, E, W, S, E):
+        states, rewards, dones, infos = env.step(np.full(3, action))
+    assert (states == start).all() and dones.all() and infos['won'].all()
+    assert (infos['final_states'] == State(1, 2, 3).id).all() and (rewards == 1).all()
+    # truncated episodes restart as well
+    for _ in range(10):
+        states, rewards, dones, infos = env.step(np.full(3, N))
+    assert dones.all() and infos['truncated'].all() and (states == start).all()
+    # every environment has its own random stream, and map when new_map
+    play = lambda env: [env.step(np.arange(8) % 4)[0] for _ in range(50)]
+    runs = [VecDungeonEnv(8, 6, 6, new_map=True, seed=1) for _ in range(2)]
+    for env in runs: env.reset()
+    assert all((x == y).all() for (x, y) in zip(*map(play, runs)))
+    maps = {tuple(c.name for c in dungeon.map) for dungeon in runs[0].dungeons}
+    assert len(maps) > 1
+    # the first maps are seeded as well, before any reset
+    runs = [VecDungeonEnv(8, 6, 6, new_map=True, seed=2) for _ in range(2)]
+    assert [list(x.map) for x in runs[0].dungeons] == [list(y.map) for y in runs[1].dungeons]
+    assert all((x == y).all() for (x, y) in zip(*map(play, runs)))
+
+def test_model_simulator():
+    from dungeon_game.simulator import ModelSimulator
+    d = Dungeon(8, 8, 1, [ValueMDP])
+    d.load_map('maps/custom_map.txt')
+    agent, = d.agents
+    simulator = ModelSimulator(agent.T, agent.index)
+    # the samples follow the transition model
+    rng = np.random.default_rng(0)
+    Ta = agent.T.matrices[0]
+    state = np.argmax(np.diff(Ta.indptr)) # the state with the most successors
+    samples = simulator.sample(np.full(100000, state), np.zeros(100000, np.int64), rng)
+    frequencies = np.bincount(samples, minlength=len(agent.index)) / len(samples)
+    assert frequencies == approx(Ta[state].toarray().ravel(), abs=0.01)
+    # a deterministic dungeon is always won, in the same number of steps
+    d = Dungeon(2, 2, 1, [ValueMDP])
+    d.map.load_as_main([t, k, s, b])
+    d.reset()
+    agent, = d.agents
+    wins, steps = ModelSimulator(agent.T, agent.index).run(agent.P, 100)
+    assert wins.all() and (steps == steps[0]).all() and steps[0] <= 6
+
+def test_parallel_evaluation():
+    from dungeon_game.evaluation import evaluate
+    from dungeon_game.characters import RandomAdventurer
+    for player in (ValueMDP, RandomAdventurer):
+        d = Dungeon(8, 8, 1, [player])
+        d.load_map('maps/map_short.txt')
+        wins, steps = evaluate(d, 1000, jobs=2, seed=3)
+        assert len(wins) == len(steps) == 1000
+        again = evaluate(d, 1000, jobs=2, seed=3)
+        assert (wins == again[0]).all() and (steps == again[1]).all()
+
+def test_policy_analysis():
+    from dungeon_game.analysis import PolicyAnalysis
+    from dungeon_game.simulator import ModelSimulator
+    from dungeon_game.batch import BatchDungeon
+    from dungeon_game.characters import AdventurerLearning
+    # a deterministic dungeon is surely won, in a fixed number of steps
+    d = Dungeon(2, 2, 1, [ValueMDP])
+    d.map.load_as_main([t, k, s, b])
+    d.reset()
+    agent, = d.agents
+    analysis = PolicyAnalysis.of(agent)
+    won, dead = analysis.steps_distribution(10)
+    assert analysis.win == approx(1) and analysis.death == approx(0)
+    assert won[int(analysis.expected_steps)] == approx(1)
+    # the games of the model follow the analysis
+    d = Dungeon(8, 8, 1, [ValueMDP])
+    d.load_map('maps/custom_map.txt')
+    agent, = d.agents
+    analysis = PolicyAnalysis.of(agent)
+    assert analysis.win + analysis.death == approx(1)
+    wins, steps = ModelSimulator(agent.T, agent.index).run(agent.P, 20000, seed=0)
+    assert wins.mean() == approx(analysis.win, abs=0.02)
+    assert steps.mean() == approx(analysis.expected_steps, rel=0.05)
+    # the softmax policy of a Q-table
+    d = Dungeon(8, 8, 1, [AdventurerLearning])
+    d.load_map('maps/map_short.txt')
+    player, = d.agents
+    player.reset_Qtable()
+    player.load_Qtable(np.random.default_rng(0).random(player.Q.shape))
+    model = d.model
+    won, dead = PolicyAnalysis.of(player).steps_distribution(2000)
+    assert d.model is model # the model of the dungeon is reused
+    wins, steps = BatchDungeon(d, 4000).run(player.play_batch, 2000)
+    assert np.mean(wins & (steps < 2000)) == approx(won[:2000].sum(), abs=0.02)
+
+def test_load_Qtable(tmp_path):
+    from dungeon_game.characters import AdventurerLearning
+    d = Dungeon(8, 16, 1, [AdventurerLearning])
+    d.load_map('maps/map_long.txt')
+    player, = d.agents
+    path = 'data/carte_long/Qtable/Qtable_10000.csv'
+    player.load_Qtable_from_file(path)
+    # the saved tables are indexed by complete ids, death excepted
+    saved = np.loadtxt(path, delimiter=',')
+    reachable = d.state_index.states[:-1]
+    assert player.Q.shape == (d.space.n_states, 4)
+    assert player.Q[:-1] == approx(saved)
+    player.save_Qtable(str(tmp_path / 'Qtable.csv'))
+    again = np.loadtxt(str(tmp_path / 'Qtable.csv'), delimiter=',')
+    assert again.shape == saved.shape and again[reachable] == approx(saved[reachable])
+
+def test_model_free_agents(monkeypatch):
+    from dungeon_game.characters import AdventurerLearning
+    # the Q-learning and human players never build the model of the map
+    def make_model(self, *args):
+        raise AssertionError("model built")
+    monkeypatch.setattr(Dungeon, 'make_model', make_model)
+    d = Dungeon(8, 16, 2, [AdventurerLearning, Adventurer])
+    d.load_map('maps/map_long.txt')
+    learner, human = d.agents
+    assert learner.Q.shape == (d.space.n_states, 4)
+    for _ in range(20):
+        old_state = learner.compact_id
+        action = learner.policy()
+        reward = d.move(learner, action)
+        learner.process_reward(old_state, learner.compact_id, action, reward)
+        assert human.state.index == human.s_id
+    learner.play_batch(np.arange(10))
+
+def test_model_cache(tmp_path):
+    from dungeon_game.cache import ModelCache
+    d = Dungeon(5, 5, 0)
+    d.model_cache = ModelCache(str(tmp_path))
+    T, R = d.make_model()
+    assert len(d.model_cache.entries()) == 1
+    cached_T, cached_R = d.make_model()
+    assert (cached_R == R).all()
+    for (Ta, Tb) in zip(T.moves + [T.S], cached_T.moves + [cached_T.S]):
+        assert abs(Ta - Tb).max() == 0
+    # another enemy probability is another model
+    d.p_enemy = 0.5
+    d.make_model()
+    assert len(d.model_cache.entries()) == 2
+    # the least recently used model is evicted
+    d.model_cache.max_size = d.model_cache.entries()[-1][1]
+    d.p_enemy = 0.6
+    d.make_model()
+    assert len(d.model_cache.entries()) == 1
+
 def test_policy_agent_long():
     print("=" * 100)
     n, m = 7, 17